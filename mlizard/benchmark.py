@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# coding=utf-8
+# This file is part of the MLizard library published under the GPL3 license.
+# Copyright (C) 2012  Klaus Greff
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for the hot paths of MLizard: stage calls, hashing, caching and
+reporting. Run with
+
+    python -m mlizard.benchmark [-o results.json] [-b baseline.json]
+
+Every benchmark is timed as the best and the median of several repetitions
+(the time is per operation). With a baseline the results are compared and
+the exit code is 1 if any benchmark got slower than the tolerance allows.
+"""
+from __future__ import division, print_function, unicode_literals
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from caches import ShelveCache, sshash
+from experiment import Experiment
+from report import CompleteReporter
+
+BENCHMARKS = []
+NO_LOGGER = logging.getLogger('ignore')
+NO_LOGGER.disabled = 1
+
+
+def benchmark(*sizes):
+    """Decorator to register a benchmark setup for each of the given sizes.
+    The setup is called with the size and returns the function to time and
+    optionally a cleanup function."""
+    def register(setup):
+        for size in sizes:
+            BENCHMARKS.append(('{}[{}]'.format(setup.__name__, size),
+                               setup, size))
+        return setup
+    return register
+
+
+class DictCache(dict):
+    """In-memory cache. Unlike a dict it is true even if empty."""
+    def sync(self):
+        pass
+
+    def __nonzero__(self):
+        return True
+
+
+def create_experiment(cache=None):
+    return Experiment('Benchmark', NO_LOGGER, NO_LOGGER, {}, cache, [], 12345)
+
+
+@benchmark(10, 10000, 1000000)
+def stage_call(size):
+    ex = create_experiment()
+
+    @ex.stage
+    def add(a, b):
+        return a + b
+
+    a = np.ones(size)
+    return lambda: add(a, 1)
+
+
+@benchmark(10, 10000, 1000000)
+def stage_call_cache_hit(size):
+    ex = create_experiment(DictCache())
+
+    @ex.stage
+    def add(a, b):
+        return a + b
+
+    add.caching_threshold = -1
+    a = np.ones(size)
+    add(a, 1)
+    call = lambda: add(a, 1)
+    call.stage = add # to check that the calls hit the cache
+    return call
+
+
+@benchmark(1000, 100000, 10000000)
+def sshash_array(size):
+    a = np.random.RandomState(0).rand(size)
+    # writable arrays are not memoized, so this hashes all the data
+    return lambda: sshash(a)
+
+
+@benchmark(10, 10000, 1000000)
+def shelve_cache_set_get(size):
+    directory = tempfile.mkdtemp()
+    cache = ShelveCache(os.path.join(directory, 'cache'))
+    value = np.ones(size)
+    counter = [0]
+
+    def set_get():
+        counter[0] += 1
+        cache[counter[0]] = value
+        return cache[counter[0]]
+
+    def cleanup():
+        cache.shelve.close()
+        shutil.rmtree(directory)
+
+    return set_get, cleanup
+
+
+@benchmark(100, 1000, 10000)
+def complete_reporter_events(size):
+    arguments = {'a': np.ones(10), 'b': 1, 'c': 'text'}
+
+    def report():
+        r = CompleteReporter()
+        r.experiment_created_event('Benchmark', {})
+        r.experiment_started_event(time.time(), 12345, (), {})
+        r.stage_created_event('stage', 'doc', 'source', None)
+        for i in range(size):
+            r.stage_started_event('stage', time.time(), arguments)
+            r.stage_completed_event(time.time())
+        r.experiment_completed_event(time.time(), None)
+    return report
+
+
+def time_function(f, repeat=5, min_time=0.1):
+    """Return the best and the median time per call of f, calling it
+    often enough that each of the repetitions takes at least min_time."""
+    number = 1
+    while True:
+        start = time.time()
+        for i in range(number):
+            f()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    times = [elapsed / number]
+    for r in range(repeat - 1):
+        start = time.time()
+        for i in range(number):
+            f()
+        times.append((time.time() - start) / number)
+    return {'best': min(times), 'median': float(np.median(times)),
+            'number': number, 'repeat': repeat}
+
+
+def run_benchmarks(pattern=None, repeat=5, min_time=0.1):
+    results = {}
+    for name, setup, size in BENCHMARKS:
+        if pattern is not None and pattern not in name:
+            continue
+        f = setup(size)
+        cleanup = None
+        if isinstance(f, tuple):
+            f, cleanup = f
+        try:
+            results[name] = time_function(f, repeat, min_time)
+        finally:
+            if cleanup is not None:
+                cleanup()
+        print('{:<40} {:>12.3f} us'.format(name, results[name]['best'] * 1e6))
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'time': time.time(),
+            'results': results}
+
+
+def compare(results, baseline, tolerance=1.25):
+    """Return the benchmarks that are slower than tolerance times their
+    best time in the baseline, as a list of (name, ratio)."""
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        if name not in baseline['results']:
+            continue
+        ratio = result['best'] / baseline['results'][name]['best']
+        print('{:<40} {:>8.2f}x'.format(name, ratio))
+        if ratio > tolerance:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MLizard benchmarks")
+    parser.add_argument('-o', '--output', help="write the results as JSON")
+    parser.add_argument('-b', '--baseline', help="compare to these results")
+    parser.add_argument('-t', '--tolerance', type=float, default=1.25,
+                        help="allowed slowdown factor relative to baseline")
+    parser.add_argument('-k', '--filter', help="only run matching benchmarks")
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help="minimum duration of each repetition")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.filter, args.repeat, args.min_time)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, ratio in regressions:
+            print('REGRESSION: {} is {:.2f}x slower'.format(name, ratio))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,8 +6,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import division, print_function, unicode_literals
 
+import bz2
+from collections import OrderedDict
+import errno
+import hashlib
+import numpy as np
+import os
 import pickle
+import Queue
 import shelve
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+try:
+    from cPickle import dumps as _dumps
+except ImportError:
+    from pickle import dumps as _dumps
 
 def sshash(obj):
     try:
@@ -19,23 +36,239 @@ def sshash(obj):
             raise TypeError("standard id-based-hash")
         return h
     except (AttributeError, TypeError):
-        # AttributeError: (probably) old-style class => pickle
-        # TypeError "unhashable type" => pickle
-        # TypeError "standard id-based-hash" => pickle
-        return hash(pickle.dumps(obj))
+        # AttributeError: (probably) old-style class => digest
+        # TypeError "unhashable type" => digest
+        # TypeError "standard id-based-hash" => digest
+        # 15 hex digits (60 bits) still fit into a plain int
+        return int(default_hasher.digest(obj)[:15], 16)
+
+
+class Hasher(object):
+    """
+    Computes deterministic SHA-256 hex-digests of (nested) objects.
+
+    Unlike sshash the result does not depend on the python process (e.g.
+    PYTHONHASHSEED), so it can be used as a persistent cache key.
+    Numbers, strings, None, tuples, lists, dicts and numpy arrays are encoded
+    canonically, everything else falls back to pickle.
+    The memory of numpy arrays is digested in place via the buffer protocol,
+    and the digests of read-only arrays are memoized for as long as the array
+    is alive.
+    """
+    def __init__(self):
+        self.memo = dict()
+
+    def digest(self, obj):
+        h = hashlib.sha256()
+        self.update(h, obj)
+        return h.hexdigest()
+
+    def update(self, h, obj):
+        if obj is None:
+            _update_chunk(h, b'N', b'')
+        elif isinstance(obj, bool):
+            _update_chunk(h, b'B', b'1' if obj else b'0')
+        elif isinstance(obj, np.ndarray):
+            _update_chunk(h, b'a', self.array_digest(obj).encode('ascii'))
+        elif isinstance(obj, np.random.RandomState):
+            # much faster than pickling it
+            _update_chunk(h, b'R', b'')
+            self.update(h, obj.get_state())
+        elif isinstance(obj, np.generic):
+            _update_chunk(h, b'g', obj.dtype.str.encode('ascii'))
+            _update_chunk(h, b'd', obj.tobytes())
+        elif isinstance(obj, (int, long)):
+            _update_chunk(h, b'i', repr(int(obj)).encode('ascii'))
+        elif isinstance(obj, float):
+            _update_chunk(h, b'f', repr(obj).encode('ascii'))
+        elif isinstance(obj, unicode):
+            _update_chunk(h, b'u', obj.encode('utf-8'))
+        elif isinstance(obj, bytes):
+            try:
+                # 'a' == u'a' so they should have the same digest
+                obj.decode('ascii')
+                _update_chunk(h, b'u', obj)
+            except UnicodeDecodeError:
+                _update_chunk(h, b'b', obj)
+        elif isinstance(obj, (tuple, list)):
+            _update_chunk(h, b't' if isinstance(obj, tuple) else b'l',
+                          str(len(obj)).encode('ascii'))
+            for o in obj:
+                self.update(h, o)
+        elif isinstance(obj, dict):
+            _update_chunk(h, b'D', str(len(obj)).encode('ascii'))
+            # order the items canonically by the digest of their keys
+            items = sorted(((self.digest(k), v) for k, v in obj.items()),
+                           key=lambda kv: kv[0])
+            for k, v in items:
+                _update_chunk(h, b'k', k.encode('ascii'))
+                self.update(h, v)
+        else:
+            _update_chunk(h, b'p', pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def array_digest(self, a):
+        memoize = is_immutable_array(a)
+        if memoize and id(a) in self.memo:
+            ref, d = self.memo[id(a)]
+            if ref() is a:
+                return d
+        h = hashlib.sha256()
+        _update_chunk(h, b'a', a.dtype.str.encode('ascii'))
+        _update_chunk(h, b's', repr(a.shape).encode('ascii'))
+        if a.dtype.hasobject:
+            # the raw memory of object arrays only contains pointers
+            _update_chunk(h, b'p', pickle.dumps(a, pickle.HIGHEST_PROTOCOL))
+        elif a.flags.c_contiguous:
+            _update_buffer(h, b'C', a)
+        else:
+            # hash everything (also fortran arrays) in C order, so equal
+            # arrays have equal digests independent of their memory layout
+            _update_buffer(h, b'C', np.ascontiguousarray(a))
+        d = h.hexdigest()
+        if memoize:
+            key = id(a)
+            self.memo[key] = weakref.ref(a, lambda r: self.memo.pop(key, None)), d
+        return d
+
+    def clear(self):
+        self.memo.clear()
+
+
+default_hasher = Hasher()
+
+
+def digest(obj):
+    """
+    Compute a deterministic SHA-256 hex-digest of obj using the default
+    Hasher.
+    """
+    return default_hasher.digest(obj)
+
+
+def is_immutable_array(a):
+    """
+    Check that neither the array nor any array it is a view of is writeable.
+    """
+    while isinstance(a, np.ndarray):
+        if a.flags.writeable:
+            return False
+        a = a.base
+    return True
+
+
+def _update_chunk(h, tag, data):
+    # length prefix every chunk so that concatenations can't collide
+    h.update(tag + str(len(data)).encode('ascii') + b':' + data)
+
+
+def _update_buffer(h, tag, a):
+    # like _update_chunk but without copying the memory of the array
+    h.update(tag + str(a.nbytes).encode('ascii') + b':')
+    h.update(a.data)
+
+
+def _blosc_module():
+    import blosc
+    return blosc
+
+
+def _lzma_module():
+    try:
+        import lzma
+    except ImportError:
+        from backports import lzma
+    return lzma
+
+
+CODECS = {
+    'zlib' : (lambda d: zlib.compress(d, 6), zlib.decompress),
+    'bz2' : (bz2.compress, bz2.decompress),
+    'lzma' : (lambda d: _lzma_module().compress(d),
+              lambda d: _lzma_module().decompress(d)),
+    'blosc' : (lambda d: _blosc_module().compress(d, typesize=8),
+               lambda d: _blosc_module().decompress(d))
+}
+
+# codecs that need an optional module, which is only imported when used
+CODEC_MODULES = {'lzma': _lzma_module, 'blosc': _blosc_module}
+
+
+def register_codec(name, compress, decompress):
+    """
+    Make a codec available for compressing cache values. compress and
+    decompress both map a bytestring to a bytestring.
+    """
+    CODECS[name] = compress, decompress
+
+
+def check_codec(codec):
+    """
+    Raise a ValueError if the codec is unknown or its module is not
+    installed, so a cache fails when it is created and not on first write.
+    """
+    if codec is None:
+        return
+    if codec not in CODECS:
+        raise ValueError("Unknown codec '{}'".format(codec))
+    if codec in CODEC_MODULES:
+        try:
+            CODEC_MODULES[codec]()
+        except ImportError as e:
+            raise ValueError("Codec '{}' is not available: {}".format(codec,
+                                                                      e))
+
+
+class EncodedValue(object):
+    """
+    A pickled and (possibly) compressed value together with the name of the
+    codec that was used to compress it (None for no compression).
+    """
+    def __init__(self, codec, data):
+        self.codec = codec
+        self.data = data
+
+    @classmethod
+    def encode(cls, value, codec, threshold=0):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if codec is None or len(data) < threshold:
+            return cls(None, data)
+        compress, _ = CODECS[codec]
+        return cls(codec, compress(data))
+
+    def decode(self):
+        data = self.data
+        if self.codec is not None:
+            _, decompress = CODECS[self.codec]
+            data = decompress(data)
+        return pickle.loads(data)
 
 
 class ShelveCache(object):
-    def __init__(self, filename):
-        self.shelve = shelve.open(filename)
+    """
+    Cache that pickles the values into a shelve. If a codec (one of CODECS)
+    is given, values that pickle to at least compression_threshold bytes are
+    compressed with it. The codec is stored with each entry, so the codec
+    can be changed without invalidating the cache.
+    """
+    def __init__(self, filename, codec=None, compression_threshold=4096):
+        check_codec(codec)
+        self.shelve = shelve.open(filename, protocol=pickle.HIGHEST_PROTOCOL)
+        self.codec = codec
+        self.compression_threshold = compression_threshold
 
     def transform_key(self, key):
-        return hex(sshash(key))
+        return str(digest(key))
 
     def __getitem__(self, item):
-        return self.shelve[self.transform_key(item)]
+        value = self.shelve[self.transform_key(item)]
+        if isinstance(value, EncodedValue):
+            value = value.decode()
+        return value
 
     def __setitem__(self, key, value):
+        if self.codec is not None:
+            value = EncodedValue.encode(value, self.codec,
+                                        self.compression_threshold)
         self.shelve[self.transform_key(key)] = value
 
     def __delitem__(self, key):
@@ -48,7 +281,631 @@ class ShelveCache(object):
     def sync(self):
         self.shelve.sync()
 
+
+class ArrayRef(object):
+    """
+    Placeholder for an array that ArrayStoreCache stored in a separate file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+
+class ArrayStoreCache(object):
+    """
+    Cache that stores the numpy arrays contained in a value (also when nested
+    in tuples, lists and dicts) as separate .npy files and returns them
+    memory-mapped. Only the small remainder of the value is pickled into a
+    shelve index. That way loading a cached result is almost instant and
+    several processes can share the same page-cached copy of the arrays.
+    Arrays smaller than array_threshold bytes are stored in the index.
+    Every write uses new (unique) array files and the old files are only
+    removed after the index points to the new ones.
+    """
+    def __init__(self, directory, mmap_mode='r', array_threshold=1024):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+        self.array_threshold = array_threshold
+        self.index = shelve.open(os.path.join(directory, 'index'))
+
+    def transform_key(self, key):
+        return str(digest(key))
+
+    def __getitem__(self, item):
+        filenames, skeleton = self.index[self.transform_key(item)]
+        try:
+            return self.restore_arrays(skeleton)
+        except (IOError, OSError):
+            # replaced or removed after we read the index
+            raise KeyError(item)
+
+    def __setitem__(self, key, value):
+        k = self.transform_key(key)
+        old_entry = self.index.get(k)
+        filenames = []
+        skeleton = self.extract_arrays(value, k, filenames)
+        # only add the index entry once all the array files are written
+        self.index[k] = filenames, skeleton
+        if old_entry is not None:
+            self.remove_files(old_entry[0])
+
+    def __delitem__(self, key):
+        k = self.transform_key(key)
+        filenames, skeleton = self.index[k]
+        del self.index[k]
+        self.remove_files(filenames)
+
+    def close(self):
+        """Write and close the index. The cache can't be used afterwards."""
+        index, self.index = getattr(self, 'index', None), None
+        if index is None:
+            return
+        db = index.dict
+        try:
+            index.close()
+        except (IOError, OSError):
+            # the directory was removed: a dumbdbm index would try to write
+            # itself again when it is collected, so drop its entries
+            if hasattr(db, '_index'):
+                db._index = None
+            raise
+
+    def __del__(self):
+        try:
+            self.close()
+        except (IOError, OSError):
+            pass # the directory is gone already
+
+    def sync(self):
+        self.index.sync()
+
+    def extract_arrays(self, value, k, filenames):
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject and \
+           value.nbytes >= self.array_threshold:
+            # a new file, so readers of the old entry are not affected
+            fd, path = tempfile.mkstemp(dir=self.directory, prefix=k + '_',
+                                        suffix='.npy')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, value)
+            filename = os.path.basename(path)
+            filenames.append(filename)
+            return ArrayRef(filename)
+        elif type(value) in (tuple, list):
+            return type(value)(self.extract_arrays(v, k, filenames)
+                               for v in value)
+        elif type(value) is dict:
+            return {n: self.extract_arrays(v, k, filenames)
+                    for n, v in value.items()}
+        else:
+            return value
+
+    def restore_arrays(self, skeleton):
+        if isinstance(skeleton, ArrayRef):
+            path = os.path.join(self.directory, skeleton.filename)
+            return np.load(path, mmap_mode=self.mmap_mode)
+        elif type(skeleton) in (tuple, list):
+            return type(skeleton)(self.restore_arrays(v) for v in skeleton)
+        elif type(skeleton) is dict:
+            return {n: self.restore_arrays(v) for n, v in skeleton.items()}
+        else:
+            return skeleton
+
+    def remove_files(self, filenames):
+        # removing a file that is still memory-mapped somewhere is fine,
+        # the data stays valid until the last map is closed
+        for filename in filenames:
+            path = os.path.join(self.directory, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class BoundedCache(object):
+    """
+    Wraps another cache and keeps the total size of its entries below
+    max_bytes by evicting entries according to the policy:
+      - 'lru': least recently used entries are evicted first
+      - 'cost': entries with the lowest execution time per byte go first
+    New results are only admitted (see offer) if their computation took at
+    least min_exec_time seconds, they fit into max_bytes at all, and (for the
+    'cost' policy) they are worth more per byte than the entries they would
+    displace. The bookkeeping is stored in the wrapped cache itself and
+    rewritten completely whenever an entry is added or removed, so it is
+    meant for a single process: several processes sharing the wrapped cache
+    would overwrite each other's index (use SQLiteCache for that).
+    """
+    INDEX_KEY = '__BoundedCache_index__'
+
+    def __init__(self, cache, max_bytes, policy='lru', min_exec_time=2):
+        if policy not in ('lru', 'cost'):
+            raise ValueError("Unknown eviction policy '{}'".format(policy))
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.min_exec_time = min_exec_time
+        try:
+            self.entries = self.cache[self.INDEX_KEY]
+        except KeyError:
+            # digest(key) -> CacheEntryInfo
+            self.entries = dict()
+        self.total_bytes = sum(e.size for e in self.entries.values())
+        # logical clock for the recency of accesses
+        self.clock = max([e.last_access for e in self.entries.values()] or [0])
+
+    def __getitem__(self, item):
+        value = self.cache[item]
+        d = digest(item)
+        if d in self.entries:
+            self.clock += 1
+            self.entries[d].last_access = self.clock
+            self.entries[d].hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if not self.offer(key, value, self.min_exec_time):
+            raise ValueError("Value does not fit into the cache.")
+
+    def __delitem__(self, key):
+        d = digest(key)
+        del self.cache[key]
+        if d in self.entries:
+            self.total_bytes -= self.entries.pop(d).size
+            self.save_index()
+
+    def sync(self):
+        self.save_index()
+        self.cache.sync()
+
+    def entry_size(self, key):
+        """The (estimated) size in bytes of the entry for key or None."""
+        entry = self.entries.get(digest(key))
+        return entry.size if entry is not None else None
+
+    def offer(self, key, value, exec_time):
+        """
+        Store the value if the admission policy accepts it. Returns whether
+        the value was stored.
+        """
+        if exec_time < self.min_exec_time:
+            return False
+        size = pickled_size(value)
+        if size > self.max_bytes:
+            return False
+        d = digest(key)
+        old_entry = self.entries.pop(d, None)
+        if old_entry is not None:
+            self.total_bytes -= old_entry.size
+        self.clock += 1
+        new_entry = CacheEntryInfo(key, size, exec_time, self.clock)
+        victims = self.select_victims(size, new_entry)
+        if victims is None:
+            if old_entry is not None:
+                self.entries[d] = old_entry
+                self.total_bytes += old_entry.size
+            return False
+        for v in victims:
+            del self.cache[v.key]
+            self.total_bytes -= self.entries.pop(digest(v.key)).size
+        self.cache[key] = value
+        self.entries[d] = new_entry
+        self.total_bytes += size
+        self.save_index()
+        return True
+
+    def select_victims(self, size, new_entry):
+        # returns None if the new entry should not be admitted
+        victims = []
+        free = self.max_bytes - self.total_bytes
+        for e in self.ranking():
+            if free >= size:
+                break
+            if self.policy == 'cost' and e.worth() >= new_entry.worth():
+                return None
+            victims.append(e)
+            free += e.size
+        return victims if free >= size else None
+
+    def ranking(self):
+        """
+        Returns the information about all entries ordered by how likely
+        they are to be evicted (first is evicted first).
+        """
+        if self.policy == 'lru':
+            return sorted(self.entries.values(), key=lambda e: e.last_access)
+        else:
+            return sorted(self.entries.values(), key=lambda e: e.worth())
+
+    def save_index(self):
+        self.cache[self.INDEX_KEY] = self.entries
+
+
+class CacheEntryInfo(object):
+    def __init__(self, key, size, exec_time, last_access):
+        self.key = key
+        self.size = size
+        self.exec_time = exec_time
+        self.last_access = last_access
+        self.hits = 0
+
+    def worth(self):
+        # seconds of computation saved per byte
+        return self.exec_time / max(self.size, 1)
+
+
+def pickled_size(value):
+    """
+    Estimate the size of value in bytes when pickled. Arrays (also nested in
+    tuples, lists and dicts) are not pickled but estimated by their nbytes,
+    everything else is pickled once.
+    """
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return value.nbytes
+    skeleton, nbytes = _strip_arrays(value)
+    return nbytes + len(_dumps(skeleton, pickle.HIGHEST_PROTOCOL))
+
+
+def _strip_arrays(value):
+    # returns value without its (nested) arrays and their total nbytes;
+    # containers without arrays are returned as they are (not copied)
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return None, value.nbytes
+    elif type(value) in (tuple, list):
+        stripped = {i: _strip_arrays(v) for i, v in enumerate(value)
+                    if type(v) in _NESTING_TYPES}
+        nbytes = sum(n for p, n in stripped.values())
+        if nbytes == 0:
+            return value, 0
+        return type(value)(stripped[i][0] if i in stripped else v
+                           for i, v in enumerate(value)), nbytes
+    elif type(value) is dict:
+        stripped = {k: _strip_arrays(v) for k, v in value.items()
+                    if type(v) in _NESTING_TYPES}
+        nbytes = sum(n for p, n in stripped.values())
+        if nbytes == 0:
+            return value, 0
+        skeleton = dict(value)
+        skeleton.update((k, p) for k, (p, n) in stripped.items())
+        return skeleton, nbytes
+    return value, 0
+
+_NESTING_TYPES = {np.ndarray, np.memmap, tuple, list, dict}
+
+
+class TieredCache(object):
+    """
+    Bounded in-memory tier in front of another (persistent) cache.
+    Hits are served from memory without unpickling, new values are written
+    through to the wrapped cache. At most max_entries values are kept in
+    memory (least recently used are dropped first). Values larger than
+    weak_threshold bytes are only referenced weakly, so they stay in memory
+    only as long as they are alive anyway (e.g. held by the experiment).
+    Note that the same object is returned for repeated hits, so results
+    must not be modified in place.
+    Values can be loaded into memory ahead of time in the background with
+    prefetch.
+    Only if the wrapped cache has an admission policy (offer), this cache
+    has one too, otherwise stages apply their own caching_threshold.
+    """
+    def __init__(self, cache, max_entries=128, weak_threshold=None):
+        self.cache = cache
+        self.max_entries = max_entries
+        self.weak_threshold = weak_threshold
+        if hasattr(cache, 'offer'):
+            self.offer = self.offer_to_backend
+        self.memory = OrderedDict()
+        self.memory_lock = threading.RLock()
+        # guards the wrapped cache unless it is thread safe (like SQLiteCache)
+        self.backend_lock = threading.RLock()
+        # digests of the keys that are being prefetched => threading.Event
+        self.pending = {}
+
+    def __getitem__(self, item):
+        d = digest(item)
+        try:
+            value = self.get_from_memory(d)
+        except KeyError:
+            event = self.pending.get(d)
+            if event is not None:
+                event.wait()  # it is being prefetched right now
+                return self[item]
+            with self.backend_lock:
+                value = self.cache[item]
+            self.put_into_memory(d, value)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.backend_lock:
+            self.cache[key] = value
+        self.put_into_memory(digest(key), value)
+
+    def __delitem__(self, key):
+        with self.memory_lock:
+            self.memory.pop(digest(key), None)
+        with self.backend_lock:
+            del self.cache[key]
+
+    def sync(self):
+        with self.backend_lock:
+            self.cache.sync()
+
+    def entry_size(self, key):
+        """The size of the entry in the wrapped cache if it knows it."""
+        if not hasattr(self.cache, 'entry_size'):
+            return None
+        with self.backend_lock:
+            return self.cache.entry_size(key)
+
+    def offer_to_backend(self, key, value, exec_time):
+        # this is the offer method if the wrapped cache has one
+        with self.backend_lock:
+            stored = self.cache.offer(key, value, exec_time)
+        if stored:
+            self.put_into_memory(digest(key), value)
+        return stored
+
+    def prefetch(self, keys, threads=4):
+        """
+        Load the values for the given keys (if cached) into memory using
+        background threads. Lookups of keys that are still being loaded wait
+        for them. Unless the wrapped cache is thread_safe, the values are
+        loaded one after the other in a single thread.
+        Note that at most max_entries values are kept in memory.
+        """
+        jobs = Queue.Queue()
+        for key in keys:
+            d = digest(key)
+            with self.memory_lock:
+                if d in self.memory or d in self.pending:
+                    continue
+                self.pending[d] = threading.Event()
+            jobs.put((key, d))
+        if not getattr(self.cache, 'thread_safe', False):
+            threads = 1
+        for i in range(min(threads, jobs.qsize())):
+            t = threading.Thread(target=self.prefetch_worker, args=(jobs,))
+            t.daemon = True
+            t.start()
+
+    def prefetch_worker(self, jobs):
+        while True:
+            try:
+                key, d = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if getattr(self.cache, 'thread_safe', False):
+                    value = self.cache[key]
+                else:
+                    with self.backend_lock:
+                        value = self.cache[key]
+                self.put_into_memory(d, value)
+            except KeyError:
+                pass
+            finally:
+                with self.memory_lock:
+                    self.pending.pop(d).set()
+
+    def get_from_memory(self, d):
+        with self.memory_lock:
+            weak, ref = self.memory.pop(d)
+            value = _dereference(ref) if weak else ref
+            self.memory[d] = weak, ref  # mark as most recently used
+        return value
+
+    def put_into_memory(self, d, value):
+        with self.memory_lock:
+            self.memory.pop(d, None)
+            if self.weak_threshold is not None and \
+               pickled_size(value) > self.weak_threshold:
+                try:
+                    self.memory[d] = True, self.weak_reference(value)
+                except TypeError:
+                    return  # can't be referenced weakly so don't keep it
+            else:
+                self.memory[d] = False, value
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def weak_reference(self, value):
+        # results are usually (result, result_logs) tuples which can't be
+        # referenced weakly themselves, so reference their parts instead
+        if type(value) is tuple:
+            return tuple(self.weak_reference(v) for v in value)
+        try:
+            return weakref.ref(value)
+        except TypeError:
+            # small parts like the result_logs dict are kept alive
+            if pickled_size(value) <= self.weak_threshold:
+                return _StrongReference(value)
+            raise
+
+
+def _dereference(ref):
+    if type(ref) is tuple:
+        return tuple(_dereference(r) for r in ref)
+    value = ref()
+    if value is None:
+        raise KeyError("Weakly referenced value is gone.")
+    return value
+
+
+class _StrongReference(object):
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
+class SQLiteCache(object):
+    """
+    Cache that can be shared by many processes on the same machine.
+    The index is an SQLite database in WAL mode (concurrent readers and one
+    writer at a time) and every value is stored as a separate blob file that
+    is written to a temporary file first and then atomically renamed.
+    Processes can reserve a key while they compute its value (see reserve),
+    so other processes wait for that computation instead of duplicating it.
+    Values can be compressed just like for ShelveCache.
+    """
+    # every thread uses its own connection
+    thread_safe = True
+
+    def __init__(self, directory, codec=None, compression_threshold=4096,
+                 timeout=60, poll_interval=0.1, stale_after=None):
+        check_codec(codec)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.codec = codec
+        self.compression_threshold = compression_threshold
+        self.timeout = timeout # seconds to wait for the database lock
+        self.poll_interval = poll_interval # seconds
+        self.stale_after = stale_after # seconds after which to break a reservation
+        self.local = threading.local()
+        with self.connection as c:
+            c.execute("CREATE TABLE IF NOT EXISTS entries ("
+                      "key TEXT PRIMARY KEY, filename TEXT, size INTEGER, "
+                      "created REAL)")
+            c.execute("CREATE TABLE IF NOT EXISTS reservations ("
+                      "key TEXT PRIMARY KEY, pid INTEGER, started REAL)")
+
+    @property
+    def connection(self):
+        return sqlite_connection(self.local,
+                                 os.path.join(self.directory, 'index.sqlite'),
+                                 self.timeout)
+
+    def transform_key(self, key):
+        return str(digest(key))
+
+    def __getitem__(self, item):
+        k = self.transform_key(item)
+        row = self.connection.execute(
+            "SELECT filename FROM entries WHERE key=?", (k,)).fetchone()
+        if row is None:
+            raise KeyError(item)
+        try:
+            with open(os.path.join(self.directory, row[0]), 'rb') as f:
+                encoded = pickle.load(f)
+        except IOError:
+            # removed after we read the index
+            raise KeyError(item)
+        return encoded.decode()
+
+    def __setitem__(self, key, value):
+        k = self.transform_key(key)
+        encoded = EncodedValue.encode(value, self.codec,
+                                      self.compression_threshold)
+        filename = k + '.blob'
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(encoded, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, os.path.join(self.directory, filename))
+        with self.connection as c:
+            c.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                      (k, filename, len(encoded.data), time.time()))
+
+    def __delitem__(self, key):
+        k = self.transform_key(key)
+        with self.connection as c:
+            row = c.execute("SELECT filename FROM entries WHERE key=?",
+                            (k,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            c.execute("DELETE FROM entries WHERE key=?", (k,))
+        path = os.path.join(self.directory, row[0])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def __contains__(self, item):
+        return self.connection.execute(
+            "SELECT 1 FROM entries WHERE key=?",
+            (self.transform_key(item),)).fetchone() is not None
+
+    def sync(self):
+        pass # every write is committed immediately
+
+    def entry_size(self, key):
+        """The stored (encoded) size in bytes of the entry for key or None."""
+        row = self.connection.execute(
+            "SELECT size FROM entries WHERE key=?",
+            (self.transform_key(key),)).fetchone()
+        return row[0] if row is not None else None
+
+    def reserve(self, key):
+        """
+        Reserve the key for computing its value. Returns True if this process
+        should compute the value (and call release(key) afterwards).
+        If another process holds the reservation, wait until it is released
+        and return False if the value is in the cache by then.
+        """
+        k = self.transform_key(key)
+        while True:
+            try:
+                with self.connection as c:
+                    c.execute("INSERT INTO reservations VALUES (?, ?, ?)",
+                              (k, os.getpid(), time.time()))
+            except sqlite3.IntegrityError:
+                pass
+            else:
+                # the value might have been stored just before we got here
+                if key not in self:
+                    return True
+                self.release(key)
+                return False
+            if key in self:
+                return False
+            self.break_stale_reservation(k)
+            time.sleep(self.poll_interval)
+
+    def release(self, key):
+        with self.connection as c:
+            c.execute("DELETE FROM reservations WHERE key=? AND pid=?",
+                      (self.transform_key(key), os.getpid()))
+
+    def break_stale_reservation(self, k):
+        row = self.connection.execute(
+            "SELECT pid, started FROM reservations WHERE key=?",
+            (k,)).fetchone()
+        if row is None:
+            return
+        pid, started = row
+        stale = not _process_alive(pid)
+        if self.stale_after is not None:
+            stale |= time.time() - started > self.stale_after
+        if stale:
+            with self.connection as c:
+                c.execute("DELETE FROM reservations WHERE key=? AND pid=? "
+                          "AND started=?", (k, pid, started))
+
+
+def sqlite_connection(local, filename, timeout):
+    """
+    The connection (in WAL mode) to the SQLite database filename for the
+    current thread and process, which is kept in the threading.local local.
+    """
+    # sqlite connections can't be shared between threads or processes
+    if getattr(local, 'pid', None) != os.getpid():
+        c = sqlite3.connect(filename, timeout=timeout)
+        c.execute("PRAGMA journal_mode=WAL")
+        local.connection = c
+        local.pid = os.getpid()
+    return local.connection
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
 class CacheStub(object):
+    def __nonzero__(self):
+        # behave like no cache at all, so stages skip building keys
+        return False
+
     def __getitem__(self, item):
         raise KeyError("Key not Found.")
 
@@ -5,25 +5,309 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-docstring
+Embedded (server-free) database of experiment runs and their stage calls.
 """
 from __future__ import division, print_function, unicode_literals
+import json
+import os
+import pickle
+import sqlite3
+import threading
 
-class StageDBInterface(object):
-    def __init__(self, db):
-        self.db = db
-        self.db_entry = None
+from caches import digest, sqlite_connection
+from report import summarize
 
-    def save(self, stage_entry):
-        assert self.db_entry is not None
-        if not stage_entry in self.db_entry['stages']:
-            self.db_entry['stages'].append(stage_entry)
-        if self.db :
-            self.db.save(self.db_entry)
 
-class DummyDB(object):
-    def __init__(self):
-        pass
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY, name TEXT, mainfile TEXT, seed INTEGER,
+    start_time REAL, stop_time REAL, result TEXT, result_data BLOB);
+CREATE INDEX IF NOT EXISTS runs_name ON runs (name, start_time);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+CREATE TABLE IF NOT EXISTS options (
+    run INTEGER, name TEXT, value TEXT, digest TEXT, PRIMARY KEY (run, name));
+CREATE INDEX IF NOT EXISTS options_digest ON options (name, digest);
+CREATE TABLE IF NOT EXISTS stage_calls (
+    id INTEGER PRIMARY KEY, run INTEGER, seq INTEGER, parent INTEGER,
+    name TEXT, start_time REAL, stop_time REAL, fingerprint TEXT, key TEXT,
+    stored INTEGER);
+CREATE UNIQUE INDEX IF NOT EXISTS stage_calls_run ON stage_calls (run, seq);
+CREATE INDEX IF NOT EXISTS stage_calls_name ON stage_calls (name, start_time);
+CREATE INDEX IF NOT EXISTS stage_calls_fingerprint
+    ON stage_calls (fingerprint, name);
+CREATE INDEX IF NOT EXISTS stage_calls_key ON stage_calls (key);
+CREATE INDEX IF NOT EXISTS stage_calls_start_time ON stage_calls (start_time);
+CREATE TABLE IF NOT EXISTS call_args (
+    call INTEGER, name TEXT, value TEXT, digest TEXT,
+    PRIMARY KEY (call, name));
+CREATE INDEX IF NOT EXISTS call_args_digest ON call_args (name, digest);
+"""
+
+
+def summary_json(value):
+    """JSON of the summary of value (see report.summarize) for display."""
+    return json.dumps(summarize(value), sort_keys=True)
+
+
+def encode_option(value):
+    """
+    The (value, digest) columns of an option: its JSON (or the JSON of its
+    summary if it is not JSON serializable) and its digest (see
+    caches.digest), which is what values are matched by.
+    """
+    try:
+        text = json.dumps(value, sort_keys=True)
+    except (TypeError, ValueError):
+        text = summary_json(value)
+    return text, digest(value)
+
+
+def encode_arguments(arguments):
+    """
+    The stage call arguments as name => (summary JSON, digest), the way
+    add_stage_calls expects them. Encode them when the call starts, so
+    later changes to mutable arguments are not recorded.
+    """
+    return {k: (summary_json(v), digest(v)) for k, v in arguments.items()}
+
+
+def pickle_value(value):
+    """The pickled value as a BLOB, or None if it can't be pickled."""
+    try:
+        return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+
+def flatten_options(options, prefix=''):
+    """Flatten nested option sections into 'section.name' keys."""
+    flat = {}
+    for k, v in options.items():
+        if isinstance(v, dict):
+            flat.update(flatten_options(v, prefix + k + '.'))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+class ExperimentDB(object):
+    """
+    SQLite database (in WAL mode, so it can be read while experiments write
+    to it) with the runs, their flattened options, seeds and results (both
+    pickled and summarized), and the stage calls with their (summarized)
+    arguments. The results of stage calls are not copied into the database,
+    but the calls refer to them by their cache key.
+    Stage calls are inserted in bulk with add_stage_calls, and runs and
+    stage calls can be found by name, source fingerprint, option or argument
+    values (matched exactly by their digest) and time range through indexed
+    queries. The cache keys of the
+    recorded calls whose results were stored in the cache tell which
+    configurations were completed already (see completed_keys and
+    load_results).
+    """
+    def __init__(self, filename, timeout=60):
+        directory = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.filename = filename
+        self.timeout = timeout # seconds to wait for the database lock
+        self.local = threading.local()
+        with self.connection as c:
+            c.executescript(SCHEMA)
+
+    @property
+    def connection(self):
+        return sqlite_connection(self.local, self.filename, self.timeout)
+
+    ############################ Writing #######################################
+    def add_run(self, name, options, seed=None, start_time=None,
+                mainfile=None):
+        """Add a run with the given options and return its id."""
+        with self.connection as c:
+            run = c.execute(
+                "INSERT INTO runs (name, mainfile, seed, start_time) "
+                "VALUES (?, ?, ?, ?)",
+                (name, mainfile, seed, start_time)).lastrowid
+            c.executemany("INSERT INTO options VALUES (?, ?, ?, ?)",
+                          [(run, k) + encode_option(v) for k, v in
+                           flatten_options(options).items()])
+        return run
+
+    def update_run(self, run, **fields):
+        """Set some of mainfile, seed, start_time, stop_time and result."""
+        if 'result' in fields:
+            fields['result_data'] = pickle_value(fields['result'])
+            fields['result'] = summary_json(fields['result'])
+        names = sorted(fields)
+        with self.connection as c:
+            c.execute("UPDATE runs SET {} WHERE id=?".format(
+                ", ".join("{}=?".format(n) for n in names)),
+                [fields[n] for n in names] + [run])
+
+    def add_stage_calls(self, run, calls):
+        """
+        Insert many stage calls of a run in one transaction. Every call is a
+        (seq, parent_seq, name, start_time, stop_time, arguments,
+        fingerprint, key, stored) tuple, where seq numbers the calls of the
+        run, parent_seq is None for top level calls, arguments are encoded
+        with encode_arguments, fingerprint and key are
+        the source fingerprint and cache key of the stage (or None) and
+        stored tells whether the result is in the cache.
+        """
+        with self.connection as c:
+            for (seq, parent, name, start_time, stop_time, arguments,
+                 fingerprint, key, stored) in calls:
+                call = c.execute(
+                    "INSERT INTO stage_calls (run, seq, parent, name, "
+                    "start_time, stop_time, fingerprint, key, stored) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run, seq, parent, name, start_time, stop_time,
+                     fingerprint, key, bool(stored))).lastrowid
+                c.executemany("INSERT INTO call_args VALUES (?, ?, ?, ?)",
+                              [(call, k, text, d) for k, (text, d)
+                               in arguments.items()])
+
+    ############################ Querying ######################################
+    def find_runs(self, name=None, options=None, started_after=None,
+                  started_before=None, completed=None):
+        """
+        Return the ids of the runs with the given name, option values
+        (dict, use 'section.name' for options in sections) and start time
+        range. With completed=True/False only (un)finished runs are
+        returned.
+        """
+        query = ["SELECT id FROM runs WHERE 1"]
+        params = []
+        if name is not None:
+            query.append("AND name=?")
+            params.append(name)
+        if started_after is not None:
+            query.append("AND start_time>=?")
+            params.append(started_after)
+        if started_before is not None:
+            query.append("AND start_time<?")
+            params.append(started_before)
+        if completed is not None:
+            query.append("AND stop_time IS {}NULL".format(
+                "NOT " if completed else ""))
+        for k, v in sorted((options or {}).items()):
+            query.append("AND id IN (SELECT run FROM options "
+                         "WHERE name=? AND digest=?)")
+            params.extend([k, digest(v)])
+        query.append("ORDER BY id")
+        rows = self.connection.execute(" ".join(query), params)
+        return [r[0] for r in rows]
+
+    def get_run(self, run):
+        """
+        The run as a dict including its options. 'result' is the unpickled
+        result and 'result_summary' its summary (see report.summarize),
+        which is also the result if it could not be pickled.
+        """
+        c = self.connection
+        row = c.execute("SELECT id, name, mainfile, seed, start_time, "
+                        "stop_time, result, result_data FROM runs WHERE id=?",
+                        (run,)).fetchone()
+        if row is None:
+            raise KeyError(run)
+        entry = dict(zip(['id', 'name', 'mainfile', 'seed', 'start_time',
+                          'stop_time', 'result_summary'], row[:-1]))
+        if entry['result_summary'] is not None:
+            entry['result_summary'] = json.loads(entry['result_summary'])
+        if row[-1] is not None:
+            entry['result'] = pickle.loads(bytes(row[-1]))
+        else:
+            entry['result'] = entry['result_summary']
+        entry['options'] = {k: json.loads(v) for k, v in c.execute(
+            "SELECT name, value FROM options WHERE run=?", (run,))}
+        return entry
+
+    def find_stage_calls(self, name=None, run=None, arguments=None,
+                         started_after=None, started_before=None,
+                         fingerprint=None, options=None, completed=None):
+        """
+        Return the stage calls with the given name, run, argument values
+        (dict), start time range and source fingerprint as dicts (without
+        the arguments). options (dict) selects the calls of runs with these
+        option values. With completed=True only calls whose result was
+        stored in the cache are returned. Note that only completed calls
+        are recorded, even if their run failed later.
+        """
+        query = ["SELECT id, run, seq, parent, name, start_time, stop_time, "
+                 "fingerprint, key, stored FROM stage_calls WHERE 1"]
+        params = []
+        if name is not None:
+            query.append("AND name=?")
+            params.append(name)
+        if fingerprint is not None:
+            query.append("AND fingerprint=?")
+            params.append(fingerprint)
+        if completed:
+            query.append("AND stored")
+        if options:
+            runs = self.find_runs(options=options)
+            query.append("AND run IN ({})".format(
+                ", ".join('?' * len(runs))))
+            params.extend(runs)
+        if run is not None:
+            query.append("AND run=?")
+            params.append(run)
+        if started_after is not None:
+            query.append("AND start_time>=?")
+            params.append(started_after)
+        if started_before is not None:
+            query.append("AND start_time<?")
+            params.append(started_before)
+        for k, v in sorted((arguments or {}).items()):
+            query.append("AND id IN (SELECT call FROM call_args "
+                         "WHERE name=? AND digest=?)")
+            params.extend([k, digest(v)])
+        query.append("ORDER BY id")
+        columns = ['id', 'run', 'seq', 'parent', 'name', 'start_time',
+                   'stop_time', 'fingerprint', 'key', 'stored']
+        rows = self.connection.execute(" ".join(query), params)
+        calls = [dict(zip(columns, r)) for r in rows]
+        for c in calls:
+            c['stored'] = bool(c['stored'])
+        return calls
+
+    def get_call_arguments(self, call):
+        """The (summarized) arguments of the stage call with the given id."""
+        return {k: json.loads(v) for k, v in self.connection.execute(
+            "SELECT name, value FROM call_args WHERE call=?", (call,))}
+
+    def completed_keys(self, keys, chunk_size=500):
+        """
+        Return the subset of the given cache keys that belong to recorded
+        (and thus completed) stage calls whose results were stored in the
+        cache. Results that were evicted from the cache since are not
+        noticed (see load_results).
+        """
+        keys = list(keys)
+        found = set()
+        c = self.connection
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            found.update(r[0] for r in c.execute(
+                "SELECT DISTINCT key FROM stage_calls WHERE stored "
+                "AND key IN ({})"
+                .format(", ".join('?' * len(chunk))), chunk))
+        return found
 
-    def save(self, a):
-        pass
\ No newline at end of file
+    def load_results(self, keys, cache):
+        """
+        Load the (result, result_logs) values for the given cache keys from
+        the cache (prefetching them if the cache supports it) and return
+        them as a dict. Keys that are not in the cache (anymore) are left
+        out.
+        """
+        keys = list(keys)
+        if hasattr(cache, 'prefetch'):
+            cache.prefetch(keys)
+        results = {}
+        for key in keys:
+            try:
+                results[key] = cache[key]
+            except KeyError:
+                pass
+        return results
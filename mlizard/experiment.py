@@ -9,9 +9,6 @@ The amazing Experiment class i dreamt up recently.
 It should be a kind of ML-Experiment-build-system-checkpointer-...
 ROADMAP:
 
- ### Caching
- - make caching key independent of comments and docstring of the stage
-
  ### configuration
  V have a kind of config-file-hierarchy so i could define some basic settings
    like paths, logging, caching, ... for my project and experiments only need
@@ -20,7 +17,6 @@ ROADMAP:
 
  ### Stage Repetition
  - count how often a stage was executed and log that
- V automatic repetition of a stage with mean and var of the result
 
  ### Version Control integration
  ! automatize rerunning an experiment by checking out the appropriate version
@@ -36,19 +32,20 @@ from __future__ import division, print_function, unicode_literals
 
 from copy import copy
 import inspect
+import multiprocessing
 import os
 import log
-from matplotlib import pyplot as plt
+import parallel
+from profiling import ExperimentStatistics
+import report
 import numpy as np
 import time
 
 
-from stage import StageFunctionOptionsView, StageFunction
+from stage import StageFunctionOptionsView, StageFunction, RANDOM_SEED_RANGE
 
 __all__ = ['Experiment']
 
-RANDOM_SEED_RANGE = 0, 1000000
-
 class Experiment(object):
     def __init__(self, name, message_logger, results_logger, options,
                  cache, observers=None, seed=None):
@@ -62,6 +59,7 @@ class Experiment(object):
         self.results_logger.addHandler(self.results_handler)
         self.stages = dict()
         self.main_stage = None
+        self.statistics = ExperimentStatistics()
         self.plot_functions = []#TODO move to some observer
         self.live_plots = []#TODO move to some observer
 
@@ -103,6 +101,14 @@ class Experiment(object):
             except AttributeError:
                 pass
 
+    def emit_statistics(self):
+        summary = self.statistics.summary()
+        for o in self.observers:
+            try:
+                o.experiment_statistics_event(summary)
+            except AttributeError:
+                pass
+
     def emit_completed(self, result):
         stop_time = time.time()
         for o in self.observers:
@@ -117,13 +123,76 @@ class Experiment(object):
         options.update(self.options[section_name])
         return OptionContext(options, self.stages.values())
 
-    def optionsets(self, section_names):
+    def optionsets(self, section_names, prefetch=False):
+        if prefetch:
+            self.prefetch(section_names)
         for sn in section_names:
             o = self.optionset(sn)
             o.__enter__()
             yield o
             o.__exit__(None, None, None)
 
+    def prefetch(self, section_names):
+        """
+        Start loading the cached results of the stages for the given option
+        sections in the background, if the cache supports it (TieredCache).
+        Only calls of stages that get all their arguments from the options
+        and don't take rnd can be predicted.
+        """
+        if not hasattr(self.cache, 'prefetch'):
+            return
+        keys = []
+        for sn in section_names:
+            options = self.optionset(sn).options
+            for stage in self.stages.values():
+                key = stage.expected_key(options)
+                if key is not None:
+                    keys.append(key)
+        self.cache.prefetch(keys)
+
+    def completed_sections(self, section_names, db, stage=None):
+        """
+        Return a dict with the sections (of section_names) for which the main
+        stage (or the stage with the given name) was already run with
+        identical arguments according to the ExperimentDB db, mapped to the
+        cache keys of those runs (see ExperimentDB.load_results).
+        """
+        stage = self.main_stage if stage is None else self.stages[stage]
+        keys = {}
+        for sn in section_names:
+            key = stage.expected_key(self.optionset(sn).options)
+            if key is not None:
+                keys[sn] = key
+        completed = db.completed_keys(keys.values())
+        return {sn: key for sn, key in keys.items() if key in completed}
+
+    def sweep(self, section_names, stage=None, processes=None):
+        """
+        Run the main stage (or the stage with the given name) once for every
+        option section in a pool of worker processes.
+        Every run starts with freshly seeded stages, so the results do not
+        depend on how the sections are distributed among the workers.
+        The observer events of the workers are forwarded to the observers of
+        this experiment. Note that the cache has to support concurrent
+        access from multiple processes (e.g. SQLiteCache).
+        Returns a list of (result, result_logs) tuples in the order of
+        section_names.
+        """
+        parallel.worker_state['experiment'] = self
+        pool = multiprocessing.Pool(processes)
+        try:
+            outputs = pool.map(parallel.run_section,
+                               [(sn, stage) for sn in section_names])
+        finally:
+            pool.close()
+            pool.join()
+            del parallel.worker_state['experiment']
+        results = []
+        for result, result_logs, events in outputs:
+            report.replay_events(events, self.observers)
+            results.append((result, result_logs))
+        return results
+
     def convert_to_stage_function(self, f):
         if isinstance(f, StageFunction): # do nothing if it is already a stage
             # do we need to allow being stage of multiple experiments?
@@ -133,8 +202,10 @@ class Experiment(object):
             stage_msg_logger = self.message_logger.getChild(stage_name)
             stage_results_logger = self.results_logger.getChild(stage_name)
             stage_seed = self.prng.randint(*RANDOM_SEED_RANGE)
-            return StageFunction(stage_name, f, self.options, stage_msg_logger,
+            stage = StageFunction(stage_name, f, self.options, stage_msg_logger,
                 stage_results_logger, stage_seed, self.observers, self.cache)
+            self.statistics.add_stage(stage.statistics)
+            return stage
 
     ################### Adding Stage functions #################################
     def stage(self, f):
@@ -150,6 +221,8 @@ class Experiment(object):
         deterministically seeded numpy.random.RandomState
         - a special 'logger' parameter is provided containing a child of
         the experiment logger with the name of the decorated function
+        - a special 'checkpoint' parameter is provided containing a
+        StageCheckpoint to save intermediate state and resume from it
         Errors are still thrown if:
         - you pass an unexpected keyword argument
         - you provide multiple values for an argument
@@ -167,13 +240,12 @@ class Experiment(object):
         if f.__module__ == "__main__":
             import sys
             args = sys.argv[1:]
+            # show all plots and wait after the run
+            self.results_handler.keep_plots_open = True
             ######## run main #########
             result = self(*args)
             ###########################
             print(result)
-            # show all plots and wait
-            plt.ioff()
-            plt.show()
             sys.exit(0)
         return self
 
@@ -184,6 +256,7 @@ class Experiment(object):
         ######## call stage #########
         result = self.main_stage.execute_function(args, kwargs, self.options)
         #############################
+        self.results_handler.stop_plots()
 
         #report.logged_results = self.results_handler.results
 
@@ -194,6 +267,7 @@ class Experiment(object):
             fig.draw()
             plots.append(fig)
         #report.plots = plots
+        self.emit_statistics()
         self.emit_completed(result)
         return result
 
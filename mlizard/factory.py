@@ -2,7 +2,6 @@
 # coding=utf-8
 from __future__ import division, print_function, unicode_literals
 
-from configobj import ConfigObj
 import logging
 import logging.config
 from StringIO import StringIO
@@ -27,6 +26,7 @@ package_logger = create_basic_stream_logger('MLizard')
 
 def createExperiment(name, config_file=None, config_string=None,
                      logger=None, seed=None, cache=None, observers=()):
+    from configobj import ConfigObj
     # reading configuration
     options = ConfigObj(unrepr=True)
     if config_file is not None:
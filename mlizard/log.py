@@ -11,8 +11,14 @@ Logging functionality for experiments
 from __future__ import division, print_function, unicode_literals
 import logging
 from collections import defaultdict
+from copy import copy
+import multiprocessing
+import numbers
+import numpy as np
+import os
+import Queue
+import tempfile
 import time
-import matplotlib.pyplot as plt
 
 SET_RESULT_LEVEL = 100
 APPEND_RESULT_LEVEL = 110
@@ -42,13 +48,267 @@ class StageFunctionLoggerFacade(object):
 
 
 
+class ResultSeries(object):
+    """
+    Compact storage for a series of appended numbers (or equally shaped
+    arrays) in a growable numpy array. Modes:
+      - 'all': keep every value. Above max_memory bytes the values are
+        moved to a memory-mapped temporary file (in spill_dir).
+      - 'downsample': keep at most capacity values by keeping only every
+        stride-th value and doubling the stride whenever the buffer is full
+        (the kept values belong to the steps returned by steps()).
+      - 'reservoir': keep a uniform random sample of capacity values.
+    Behaves like a (read-only) sequence and pickles as a plain array.
+    """
+    def __init__(self, first_value, mode='all', capacity=1024,
+                 max_memory=100 * 2**20, spill_dir=None):
+        if mode not in ('all', 'downsample', 'reservoir'):
+            raise ValueError("Unknown mode '{}'".format(mode))
+        first_value = np.asarray(first_value)
+        self.mode = mode
+        self.capacity = capacity
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.spill_file = None
+        self.item_shape = first_value.shape
+        self.values = np.empty((16 if mode == 'all' else capacity,) +
+                               self.item_shape, dtype=first_value.dtype)
+        self.length = 0 # number of stored values
+        self.count = 0 # number of appended values
+        self.stride = 1
+        self.sampler = np.random.RandomState(0)
+        self.append(first_value)
+
+    def fits(self, value):
+        value = np.asarray(value)
+        return value.shape == self.item_shape and \
+            value.dtype.kind in 'biufc'
+
+    def append(self, value):
+        value = np.asarray(value)
+        if not np.can_cast(value.dtype, self.values.dtype):
+            self.resize(len(self.values),
+                        np.promote_types(value.dtype, self.values.dtype))
+        self.count += 1
+        if self.mode == 'all':
+            if self.length == len(self.values):
+                self.resize(2 * len(self.values))
+            self.values[self.length] = value
+            self.length += 1
+        elif self.mode == 'downsample':
+            if (self.count - 1) % self.stride:
+                return
+            if self.length == self.capacity:
+                # keep every other value
+                kept = self.values[:self.length:2].copy()
+                self.length = len(kept)
+                self.values[:self.length] = kept
+                self.stride *= 2
+                if (self.count - 1) % self.stride:
+                    return
+            self.values[self.length] = value
+            self.length += 1
+        else:  # reservoir
+            if self.length < self.capacity:
+                self.values[self.length] = value
+                self.length += 1
+            else:
+                i = self.sampler.randint(self.count)
+                if i < self.capacity:
+                    self.values[i] = value
+
+    def resize(self, size, dtype=None):
+        dtype = dtype or self.values.dtype
+        shape = (size,) + self.item_shape
+        nbytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+        old_spill_file = self.spill_file
+        if nbytes > self.max_memory:
+            fd, self.spill_file = tempfile.mkstemp(suffix='.series',
+                                                   dir=self.spill_dir)
+            os.close(fd)
+            values = np.memmap(self.spill_file, dtype=dtype, mode='w+',
+                               shape=shape)
+        else:
+            self.spill_file = None
+            values = np.empty(shape, dtype=dtype)
+        values[:self.length] = self.values[:self.length]
+        self.values = values
+        if old_spill_file is not None:
+            os.remove(old_spill_file)
+
+    def steps(self):
+        """The indices of the stored values in the series of all values."""
+        if self.mode == 'downsample':
+            return np.arange(self.length) * self.stride
+        return np.arange(self.length)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        return self.values[:self.length][item]
+
+    def __iter__(self):
+        return iter(self.values[:self.length])
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.values[:self.length], dtype=dtype)
+
+    def __eq__(self, other):
+        try:
+            return self.tolist() == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def tolist(self):
+        return self.values[:self.length].tolist()
+
+    def __repr__(self):
+        return "ResultSeries({})".format(self.values[:self.length])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['values'] = np.array(self.values[:self.length])
+        state['spill_file'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __del__(self):
+        if self.spill_file is not None and os.path.exists(self.spill_file):
+            self.values = None
+            os.remove(self.spill_file)
+
+
+def is_numeric(value):
+    if isinstance(value, (numbers.Number, np.generic)):
+        return True
+    return isinstance(value, np.ndarray) and value.dtype.kind in 'biufc'
+
+
+class LivePlotRenderer(object):
+    """
+    Feeds snapshots of the results to the live plot generators in a separate
+    (forked) process, so slow plotting never blocks the logging stage and
+    pyplot is only used from the main thread of that process.
+    Only the newest snapshot is rendered, and the delay between frames adapts
+    such that rendering takes at most the given fraction (load) of the time.
+    Failing plots are logged and dropped, they never affect the stage.
+    """
+    STOP, KEEP_OPEN = 'stop', 'keep_open'
+
+    def __init__(self, plot_generators, min_delay=0.5, max_delay=10.,
+                 load=0.2):
+        self.plot_generators = list(plot_generators)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.load = load
+        self.queue = multiprocessing.Queue()
+        # written by the renderer process
+        self.render_time = multiprocessing.Value('d', 0.)
+        self.frame_count = multiprocessing.Value('i', 0)
+        self.process = multiprocessing.Process(target=self.run)
+        self.process.daemon = True
+        self.process.start()
+
+    @property
+    def delay(self):
+        return min(self.max_delay,
+                   max(self.min_delay, self.render_time.value / self.load))
+
+    @property
+    def frames(self):
+        return self.frame_count.value
+
+    def submit(self, results):
+        self.queue.put(results)
+
+    def stop(self, keep_open=False, timeout=None):
+        """
+        Stop the renderer after the submitted results are rendered. With
+        keep_open the open figures are shown until the user closes them.
+        """
+        self.queue.put(self.KEEP_OPEN if keep_open else self.STOP)
+        self.process.join(None if keep_open else timeout)
+
+    def run(self):
+        logger = logging.getLogger('MLizard')
+        plots = None
+        command = None
+        while command is None:
+            results = None
+            item = self.queue.get()
+            while True:
+                # skip to the newest snapshot
+                if isinstance(item, dict):
+                    results = item
+                else:
+                    command = item
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            if results is not None:
+                plots = self.render(plots, results, logger)
+        if command == self.KEEP_OPEN and plots:
+            try:
+                import matplotlib.pyplot as plt
+                if plt.get_fignums():
+                    plt.ioff()
+                    plt.show()
+            except Exception:
+                logger.exception("Showing the live plots failed.")
+
+    def render(self, plots, results, logger):
+        # returns the plots that are still alive
+        if plots == []:
+            return plots
+        start = time.time()
+        try:
+            import matplotlib.pyplot as plt
+            if plots is None:
+                plt.ion()
+                plots = []
+                for plot_gen in self.plot_generators:
+                    plot = plot_gen()
+                    plots.append({'plot': plot, 'fig': plot.next()})
+            for p in plots[:]:
+                try:
+                    p['fig'] = p['plot'].send(results)
+                except StopIteration:
+                    plots.remove(p)
+            if plt.get_fignums():
+                plt.draw()
+        except Exception:
+            logger.exception("Live plotting failed and is turned off.")
+            return []
+        self.frame_count.value += 1
+        self.render_time.value = time.time() - start
+        return plots
+
+
 class ResultLogHandler(logging.Handler):
-    def __init__(self, level=logging.NOTSET):
+    """
+    Collects the results logged through a StageFunctionLoggerFacade.
+    Appended numbers (and arrays) are stored in ResultSeries with the given
+    series_mode, series_capacity and max_memory (see ResultSeries), all
+    other appended values in lists.
+    """
+    def __init__(self, level=logging.NOTSET, series_mode='all',
+                 series_capacity=1024, max_memory=100 * 2**20):
         super(ResultLogHandler, self).__init__(level=level)
         self.results = defaultdict(list)
+        self.series_mode = series_mode
+        self.series_capacity = series_capacity
+        self.max_memory = max_memory
         self.plot_generators = []
-        self.plots = None
+        self.renderer = None
         self.plotting_delay = 0.5 # seconds
+        self.keep_plots_open = False
         self.plot_time = 0
 
     def filter(self, record):
@@ -59,25 +319,47 @@ class ResultLogHandler(logging.Handler):
             self.results.update(record.set_dict)
         elif record.levelno == APPEND_RESULT_LEVEL:
             for k, v in record.append_dict.items():
-                self.results[k].append(v)
+                self.append(k, v)
 
         # check for plotting
-        t = time.time()
-        if t - self.plot_time > self.plotting_delay:
-            if self.plots is None:
+        if self.plot_generators:
+            t = time.time()
+            if self.renderer is None:
                 self.start_plots()
-            self.plot_time = t
-            for p in self.plots:
-                p['fig'] = p['plot'].send(self.results)
-                plt.draw()
+            if t - self.plot_time > self.renderer.delay:
+                self.plot_time = t
+                self.renderer.submit(self.snapshot())
+
+    def append(self, key, value):
+        series = self.results.get(key)
+        if series is None and is_numeric(value):
+            self.results[key] = ResultSeries(value, self.series_mode,
+                                             self.series_capacity,
+                                             self.max_memory)
+        elif isinstance(series, ResultSeries) and not series.fits(value):
+            # fall back to a list
+            self.results[key] = series.tolist() + [value]
+        else:
+            self.results[key].append(value)
+
+    def snapshot(self):
+        """Copy of the results that is safe to hand to another thread."""
+        return {k: np.array(v) if isinstance(v, ResultSeries) else copy(v)
+                for k, v in self.results.items()}
 
     def start_plots(self):
-        plt.ion()
-        self.plots = []
-        for plot_gen in self.plot_generators:
-            plot = plot_gen()
-            self.plots.append({'plot':plot,
-                               'fig':plot.next()})
+        self.renderer = LivePlotRenderer(self.plot_generators,
+                                         min_delay=self.plotting_delay)
+
+    def stop_plots(self):
+        """
+        Render the final results and stop the renderer. If keep_plots_open
+        is set, this waits until the user has closed the plot windows.
+        """
+        if self.renderer is not None:
+            self.renderer.submit(self.snapshot())
+            self.renderer.stop(self.keep_plots_open)
+            self.renderer = None
 
     def add_plot(self, plot):
         if not plot in self.plot_generators:
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# coding=utf-8
+# This file is part of the MLizard library published under the GPL3 license.
+# Copyright (C) 2012  Klaus Greff
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Running stages in a pool of worker processes.
+The workers are forked, so they inherit the experiment through the
+module-level worker_state instead of having to unpickle it.
+"""
+from __future__ import division, print_function, unicode_literals
+import numpy as np
+
+from log import ResultLogHandler
+from report import ExperimentObserver
+
+worker_state = dict()
+
+
+class EventRecorder(ExperimentObserver):
+    """
+    Observer that records all events such that they can be sent to another
+    process and be replayed there (see replay_events).
+    """
+    def __init__(self):
+        self.events = []
+
+    def experiment_created_event(self, name, options):
+        self.events.append(('experiment_created_event', (name, options)))
+
+    def experiment_mainfile_found_event(self, mainfile, doc):
+        self.events.append(('experiment_mainfile_found_event', (mainfile, doc)))
+
+    def experiment_started_event(self, start_time, seed, args, kwargs):
+        self.events.append(('experiment_started_event',
+                            (start_time, seed, args, kwargs)))
+
+    def experiment_statistics_event(self, statistics):
+        self.events.append(('experiment_statistics_event', (statistics,)))
+
+    def experiment_completed_event(self, stop_time, result):
+        self.events.append(('experiment_completed_event', (stop_time, result)))
+
+    def stage_created_event(self, name, doc, source, signature):
+        self.events.append(('stage_created_event',
+                            (name, doc, source, signature)))
+
+    def stage_started_event(self, name, start_time, arguments):
+        # the logger and checkpoint can't be sent to another process
+        arguments = {k: v for k, v in arguments.items()
+                     if k not in ('logger', 'checkpoint')}
+        self.events.append(('stage_started_event',
+                            (name, start_time, arguments)))
+
+    def stage_key_event(self, name, fingerprint, key, stored):
+        self.events.append(('stage_key_event',
+                            (name, fingerprint, key, stored)))
+
+    def stage_completed_event(self, stop_time):
+        self.events.append(('stage_completed_event', (stop_time,)))
+
+
+def reseed_stages(stages):
+    # so the result doesn't depend on what the worker did before
+    for stage in stages:
+        stage.random = np.random.RandomState(stage.seed)
+
+
+def run_section(job):
+    """
+    Run a stage of the experiment in worker_state with the options of an
+    option section. Returns the result, the result logs and the recorded
+    observer events.
+    """
+    section_name, stage_name = job
+    ex = worker_state['experiment']
+    recorder = EventRecorder()
+    # the stages share this list with the experiment
+    ex.observers[:] = [recorder]
+    ex.results_logger.removeHandler(ex.results_handler)
+    stage = ex.main_stage if stage_name is None else ex.stages[stage_name]
+    reseed_stages(ex.stages.values() + [stage])
+    options = ex.optionset(section_name).options
+    results_handler = ResultLogHandler()
+    ex.results_logger.addHandler(results_handler)
+    try:
+        result = stage.execute_function((), {}, options)
+    finally:
+        ex.results_logger.removeHandler(results_handler)
+    return result, dict(results_handler.results), recorder.events
+
+
+def run_repetition(job):
+    """
+    Run one repetition of the stage in worker_state (see
+    StageFunction.repeat).
+    """
+    return worker_state['stage'].run_repetition(job)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# coding=utf-8
+# This file is part of the MLizard library published under the GPL3 license.
+# Copyright (C) 2012  Klaus Greff
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Timing statistics and optional profiling of stages.
+"""
+from __future__ import division, print_function, unicode_literals
+import cProfile
+import numpy as np
+import pstats
+import random
+
+
+class StageStatistics(object):
+    """
+    Counters and timings for all the calls of one stage.
+    Percentiles are computed from a reservoir sample of at most
+    reservoir_size wall times, so memory stays bounded.
+    If profiling is enabled, calls that execute the stage run under cProfile
+    and the accumulated pstats.Stats are available as profile_stats.
+    Cache traffic (bytes_read, bytes_written) is only counted if the cache
+    knows the size of its entries (see BoundedCache.entry_size).
+    """
+    def __init__(self, name, reservoir_size=1000):
+        self.name = name
+        self.calls = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.total_time = 0.
+        self.min_time = float('inf')
+        self.max_time = 0.
+        self.total_cpu_time = 0.
+        self.min_cpu_time = float('inf')
+        self.max_cpu_time = 0.
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.reservoir_size = reservoir_size
+        self.samples = []
+        self.sampler = random.Random(0)
+        self.profiling = False
+        self.profile_stats = None
+
+    def add_call(self, wall_time, cpu_time, cache_hit=None):
+        """
+        Record one call. cache_hit is None if there was no cache lookup.
+        """
+        self.calls += 1
+        if cache_hit is True:
+            self.cache_hits += 1
+        elif cache_hit is False:
+            self.cache_misses += 1
+        self.total_time += wall_time
+        self.min_time = min(self.min_time, wall_time)
+        self.max_time = max(self.max_time, wall_time)
+        self.total_cpu_time += cpu_time
+        self.min_cpu_time = min(self.min_cpu_time, cpu_time)
+        self.max_cpu_time = max(self.max_cpu_time, cpu_time)
+        if len(self.samples) < self.reservoir_size:
+            self.samples.append(wall_time)
+        else:
+            i = self.sampler.randint(0, self.calls - 1)
+            if i < self.reservoir_size:
+                self.samples[i] = wall_time
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.calls if self.calls else 0.
+
+    def percentile(self, q):
+        """Approximate q-th percentile of the wall time of a call."""
+        return np.percentile(self.samples, q) if self.samples else 0.
+
+    def run_profiled(self, f, kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(f, **kwargs)
+        finally:
+            if self.profile_stats is None:
+                self.profile_stats = pstats.Stats(profile)
+            else:
+                self.profile_stats.add(profile)
+
+    def summary(self):
+        return dict(
+            name=self.name,
+            calls=self.calls,
+            cache_hits=self.cache_hits,
+            cache_misses=self.cache_misses,
+            total_time=self.total_time,
+            mean_time=self.mean_time,
+            min_time=self.min_time if self.calls else 0.,
+            max_time=self.max_time,
+            median_time=self.percentile(50),
+            p90_time=self.percentile(90),
+            p99_time=self.percentile(99),
+            total_cpu_time=self.total_cpu_time,
+            min_cpu_time=self.min_cpu_time if self.calls else 0.,
+            max_cpu_time=self.max_cpu_time,
+            bytes_read=self.bytes_read,
+            bytes_written=self.bytes_written)
+
+
+class ExperimentStatistics(object):
+    """
+    The StageStatistics of all stages of an experiment by stage name.
+    """
+    def __init__(self):
+        self.stages = dict()
+
+    def add_stage(self, stage_statistics):
+        self.stages[stage_statistics.name] = stage_statistics
+
+    def __getitem__(self, item):
+        return self.stages[item]
+
+    def __iter__(self):
+        return iter(self.stages)
+
+    def hottest(self, n=None, by='total_time'):
+        """
+        Return the statistics of the n stages with the highest value of the
+        given attribute (e.g. 'total_time', 'calls', 'bytes_read').
+        """
+        ordered = sorted(self.stages.values(),
+                         key=lambda s: getattr(s, by), reverse=True)
+        return ordered[:n]
+
+    def profile(self, stage_name, enable=True):
+        """Enable (or disable) cProfile for all calls of the given stage."""
+        self.stages[stage_name].profiling = enable
+
+    def summary(self):
+        """List of the summaries of all stages ordered by total time."""
+        return [s.summary() for s in self.hottest()]
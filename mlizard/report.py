@@ -1,9 +1,14 @@
 #!/usr/bin/python
 # coding=utf-8
 from __future__ import division, print_function, unicode_literals
+from array import array
 import datetime
+import logging
+import os
+import Queue
+from repr import Repr
+import threading
 import time
-from jinja2 import PackageLoader
 
 IDLE, STARTED, STAGE_RUNNING, FINISHED = range(4)
 
@@ -17,6 +22,9 @@ class ExperimentObserver(object):
     def experiment_started_event(self, start_time, seed, args, kwargs):
         pass
 
+    def experiment_statistics_event(self, statistics):
+        pass
+
     def experiment_completed_event(self, stop_time, result):
         pass
 
@@ -26,13 +34,193 @@ class ExperimentObserver(object):
     def stage_started_event(self, name, start_time, arguments):
         pass
 
+    def stage_key_event(self, name, fingerprint, key, stored):
+        pass
+
     def stage_completed_event(self, stop_time):
         pass
 
+def replay_events(events, observers):
+    """
+    Deliver a list of (event_name, args) tuples to the observers.
+    """
+    for event, args in events:
+        for o in observers:
+            try:
+                getattr(o, event)
+            except AttributeError:
+                continue
+            getattr(o, event)(*args)
+
+
+class AsyncDispatcher(ExperimentObserver):
+    """
+    Observer that queues all events and delivers them to the given observers
+    from a background thread, so slow observers don't slow down the stages.
+    Events are delivered in batches of up to batch_size. Observers with a
+    process_events(events) method get each batch at once (e.g. to save only
+    once per batch), the others get the events one by one.
+    If more than max_queue_size events are pending, emitting an event
+    blocks until the observers have caught up. The queue is flushed when the
+    experiment completes.
+    Note that mutable event arguments are not copied.
+    """
+    def __init__(self, observers, max_queue_size=10000, batch_size=100):
+        self.observers = list(observers)
+        self.queue = Queue.Queue(max_queue_size)
+        self.batch_size = batch_size
+        self.logger = logging.getLogger('MLizard')
+        self.thread = threading.Thread(target=self.deliver_events)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, event, args):
+        self.queue.put((event, args))
+
+    def flush(self):
+        """Block until all queued events are delivered."""
+        self.queue.join()
+
+    def deliver_events(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self.deliver(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def deliver(self, batch):
+        for o in self.observers:
+            try:
+                if hasattr(o, 'process_events'):
+                    o.process_events(batch)
+                else:
+                    replay_events(batch, [o])
+            except Exception:
+                self.logger.exception("Observer %s failed.", o)
+
+    def experiment_created_event(self, name, options):
+        self.put('experiment_created_event', (name, options))
+
+    def experiment_mainfile_found_event(self, mainfile, doc):
+        self.put('experiment_mainfile_found_event', (mainfile, doc))
+
+    def experiment_started_event(self, start_time, seed, args, kwargs):
+        self.put('experiment_started_event', (start_time, seed, args, kwargs))
+
+    def experiment_statistics_event(self, statistics):
+        self.put('experiment_statistics_event', (statistics,))
+
+    def experiment_completed_event(self, stop_time, result):
+        self.put('experiment_completed_event', (stop_time, result))
+        self.flush()
+
+    def stage_created_event(self, name, doc, source, signature):
+        self.put('stage_created_event', (name, doc, source, signature))
+
+    def stage_started_event(self, name, start_time, arguments):
+        self.put('stage_started_event', (name, start_time, arguments))
+
+    def stage_key_event(self, name, fingerprint, key, stored):
+        self.put('stage_key_event', (name, fingerprint, key, stored))
+
+    def stage_completed_event(self, stop_time):
+        self.put('stage_completed_event', (stop_time,))
+
+
+class CallTable(object):
+    """
+    Append-only table of stage calls stored in compact columns: stage id,
+    parent call index (-1 for top level calls), start and stop time (NaN
+    while running) and the id of the summarized arguments. Identical
+    argument summaries are stored only once and the arguments themselves
+    are never referenced.
+    """
+    def __init__(self):
+        self.stage_names = []
+        self.stage_ids = {}
+        self.summaries = []
+        self.summary_ids = {}
+        self.stage = array(b'i')
+        self.parent = array(b'i')
+        self.start_time = array(b'd')
+        self.stop_time = array(b'd')
+        self.arguments = array(b'i')
+
+    def __len__(self):
+        return len(self.stage)
+
+    def add_call(self, name, parent, start_time, arguments):
+        """Add a running call and return its index."""
+        if name not in self.stage_ids:
+            self.stage_ids[name] = len(self.stage_names)
+            self.stage_names.append(name)
+        summary = tuple(sorted((k, summarize(v))
+                               for k, v in arguments.items()))
+        if summary not in self.summary_ids:
+            self.summary_ids[summary] = len(self.summaries)
+            self.summaries.append(summary)
+        self.stage.append(self.stage_ids[name])
+        self.parent.append(parent)
+        self.start_time.append(start_time)
+        self.stop_time.append(float('nan'))
+        self.arguments.append(self.summary_ids[summary])
+        return len(self.stage) - 1
+
+    def complete_call(self, index, stop_time):
+        self.stop_time[index] = stop_time
+
+    def entry(self, index):
+        """The call as a dict (without the called list)."""
+        start_time = self.start_time[index]
+        stop_time = self.stop_time[index]
+        if stop_time != stop_time:  # NaN: still running
+            stop_time = execution_time = None
+        else:
+            execution_time = stop_time - start_time
+        return dict(name=self.stage_names[self.stage[index]],
+                    start_time=start_time,
+                    stop_time=stop_time,
+                    execution_time=execution_time,
+                    arguments=dict(self.summaries[self.arguments[index]]))
+
+    def build_tree(self, max_calls=None):
+        """
+        The calls as nested dicts with a 'called' list each. With max_calls
+        only the first max_calls calls are included (parents always come
+        before their children, so this is still a complete tree).
+        """
+        roots = []
+        entries = []
+        n = len(self) if max_calls is None else min(len(self), max_calls)
+        for i in range(n):
+            entry = self.entry(i)
+            entry['called'] = []
+            entries.append(entry)
+            parent = self.parent[i]
+            (roots if parent < 0 else entries[parent]['called']).append(entry)
+        return roots
+
+
 class CompleteReporter(ExperimentObserver):
+    """
+    Collects all events into the experiment_entry dict. The stage calls are
+    kept in a compact CallTable (with summarized arguments) and turned into
+    the nested 'called' lists by build_call_tree when the experiment
+    completes (only the first max_call_details calls, if that is set).
+    """
+    max_call_details = None
+
     def __init__(self):
         self.experiment_entry = dict()
-        self.stack = [self.experiment_entry]
+        self.calls = CallTable()
+        self.stack = []  # indices of the running calls
 
     def experiment_created_event(self, name, options):
         self.experiment_entry['name'] = name
@@ -49,11 +237,21 @@ class CompleteReporter(ExperimentObserver):
         self.experiment_entry['args'] = args
         self.experiment_entry['kwargs'] = kwargs
         self.experiment_entry['called'] = []
+        self.calls = CallTable()
+        self.stack = []
+
+    def experiment_statistics_event(self, statistics):
+        self.experiment_entry['statistics'] = statistics
 
     def experiment_completed_event(self, stop_time, result):
         self.experiment_entry['stop_time'] = stop_time
         self.experiment_entry['execution_time'] = stop_time - self.experiment_entry['start_time']
         self.experiment_entry['result'] = result
+        self.experiment_entry['called'] = self.build_call_tree(
+            self.max_call_details)
+
+    def build_call_tree(self, max_calls=None):
+        return self.calls.build_tree(max_calls)
 
     def stage_created_event(self, name, doc, source, signature):
         stage_entry = dict(
@@ -63,34 +261,88 @@ class CompleteReporter(ExperimentObserver):
         self.experiment_entry['stages'][name] = stage_entry
 
     def stage_started_event(self, name, start_time, arguments):
-        stage_entry = dict(
-            name=name,
-            start_time=start_time,
-            arguments=arguments,
-            called=[]
-            )
-        self.stack[-1]['called'].append(stage_entry)
-        self.stack.append(stage_entry)
+        parent = self.stack[-1] if self.stack else -1
+        self.stack.append(self.calls.add_call(name, parent, start_time,
+                                              arguments))
 
     def stage_completed_event(self, stop_time):
-        stage_entry = self.stack.pop()
-        stage_entry['stop_time'] = stop_time
-        stage_entry['execution_time'] = stop_time - stage_entry['start_time']
+        self.calls.complete_call(self.stack.pop(), stop_time)
+
+# (type, shape, dtype) => summary, because formatting dtypes is slow
+_array_summaries = {}
+
+
+class _SummaryRepr(Repr):
+    # like repr, but only looks at the first few elements of the builtin
+    # containers and describes other containers by their type and length
+    def __init__(self):
+        Repr.__init__(self)
+        self.maxstring = self.maxother = 80
+
+    def repr1(self, x, level):
+        typename = type(x).__name__
+        if not hasattr(self, 'repr_' + typename):
+            if hasattr(x, 'shape') and hasattr(x, 'dtype'):
+                return summarize(x)
+            if hasattr(x, '__len__') and hasattr(x, '__iter__'):
+                try:
+                    return "<{} len={}>".format(typename, len(x))
+                except TypeError:
+                    pass
+        return Repr.repr1(self, x, level)
+
+    repr_unicode = Repr.repr_str
+
+_summary_repr = _SummaryRepr()
+
+
+def summarize(value, max_length=80):
+    """
+    Return a short summary of value that can be stored as JSON: numbers,
+    None and short strings are kept, arrays are described by their shape
+    and dtype and everything else by its (truncated) repr. Containers are
+    summarized without building their full repr.
+    """
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        k = type(value), value.shape, value.dtype
+        try:
+            return _array_summaries[k]
+        except KeyError:
+            if len(_array_summaries) > 1000:
+                _array_summaries.clear()
+            summary = "<{} shape={} dtype={}>".format(k[0].__name__, k[1],
+                                                      k[2])
+            _array_summaries[k] = summary
+            return summary
+    if not isinstance(value, basestring):
+        value = _summary_repr.repr(value)
+    if len(value) > max_length:
+        value = value[:max_length - 3] + '...'
+    return value
+
+
+def connect_couchdb(url=None, db_name='mlizard_experiments'):
+    import couchdb
+    if url:
+        couch = couchdb.Server(url)
+    else:
+        couch = couchdb.Server()
+    if db_name in couch:
+        return couch[db_name]
+    else:
+        return couch.create(db_name)
+
 
 class CouchDBReporter(CompleteReporter):
     def __init__(self, url=None, db_name='mlizard_experiments'):
         super(CouchDBReporter, self).__init__()
-        import couchdb
-        if url:
-            couch = couchdb.Server(url)
-        else:
-            couch = couchdb.Server()
-        if db_name in couch:
-            self.db = couch[db_name]
-        else:
-            self.db = couch.create(db_name)
+        self.db = connect_couchdb(url, db_name)
 
     def save(self):
+        if 'called' in self.experiment_entry:
+            self.experiment_entry['called'] = self.build_call_tree()
         self.db.save(self.experiment_entry)
 
     def experiment_created_event(self, name, options):
@@ -121,29 +373,238 @@ class CouchDBReporter(CompleteReporter):
         CompleteReporter.stage_completed_event(self, stop_time)
         self.save()
 
+    def process_events(self, events):
+        # used by the AsyncDispatcher: save only once per batch
+        for event, args in events:
+            getattr(CompleteReporter, event)(self, *args)
+        self.save()
+
+class IncrementalCouchDBReporter(ExperimentObserver):
+    """
+    Reports to CouchDB like the CouchDBReporter, but instead of rewriting
+    the whole experiment document on every event, every stage call is
+    written as a separate small document (with summarized arguments) that
+    references the experiment and its parent call. Those documents are
+    written in bulk when batch_size of them are pending or flush_interval
+    seconds have passed. The experiment document itself is only written
+    when the experiment is created, started and completed.
+    """
+    def __init__(self, url=None, db_name='mlizard_experiments', db=None,
+                 batch_size=100, flush_interval=5):
+        self.db = db if db is not None else connect_couchdb(url, db_name)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # seconds
+        self.experiment_entry = {'type' : 'experiment', 'stages' : {}}
+        self.stack = []
+        self.pending = []
+        self.call_count = 0
+        self.last_flush = time.time()
+
+    def save(self):
+        self.db.save(self.experiment_entry)
+
+    def flush(self):
+        if self.pending:
+            self.db.update(self.pending)
+            self.pending = []
+        self.last_flush = time.time()
+
+    def experiment_created_event(self, name, options):
+        self.experiment_entry['name'] = name
+        self.experiment_entry['options'] = options
+        self.save()
+
+    def experiment_mainfile_found_event(self, mainfile, doc):
+        self.experiment_entry['mainfile'] = mainfile
+        self.experiment_entry['doc'] = doc
+
+    def experiment_started_event(self, start_time, seed, args, kwargs):
+        self.experiment_entry['start_time'] = start_time
+        self.experiment_entry['seed'] = seed
+        self.experiment_entry['args'] = args
+        self.experiment_entry['kwargs'] = kwargs
+        self.save()
+
+    def experiment_statistics_event(self, statistics):
+        self.experiment_entry['statistics'] = statistics
+
+    def experiment_completed_event(self, stop_time, result):
+        self.flush()
+        self.experiment_entry['stop_time'] = stop_time
+        self.experiment_entry['execution_time'] = \
+            stop_time - self.experiment_entry['start_time']
+        self.experiment_entry['result'] = result
+        self.experiment_entry['stage_calls'] = self.call_count
+        self.save()
+
+    def stage_created_event(self, name, doc, source, signature):
+        # written together with the experiment document
+        self.experiment_entry['stages'][name] = dict(
+            source=source,
+            doc=doc,
+            signature=signature)
+
+    def stage_started_event(self, name, start_time, arguments):
+        experiment_id = self.experiment_entry['_id']
+        call_entry = {
+            '_id' : "{}-{}".format(experiment_id, self.call_count),
+            'type' : 'stage_call',
+            'experiment' : experiment_id,
+            'parent' : self.stack[-1]['_id'] if self.stack else None,
+            'name' : name,
+            'start_time' : start_time,
+            'arguments' : {k: summarize(v) for k, v in arguments.items()
+                           if k != 'logger'}}
+        self.call_count += 1
+        self.stack.append(call_entry)
+
+    def stage_key_event(self, name, fingerprint, key, stored):
+        self.stack[-1]['fingerprint'] = fingerprint
+        self.stack[-1]['key'] = key
+        self.stack[-1]['stored'] = stored
+
+    def stage_completed_event(self, stop_time):
+        call_entry = self.stack.pop()
+        call_entry['stop_time'] = stop_time
+        call_entry['execution_time'] = stop_time - call_entry['start_time']
+        self.pending.append(call_entry)
+        if len(self.pending) >= self.batch_size or \
+           time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+
+class SQLiteReporter(ExperimentObserver):
+    """
+    Records the experiment and its stage calls (with summarized arguments)
+    in an ExperimentDB (see db.py) that needs no server. Completed stage
+    calls are inserted in bulk when batch_size of them are pending or
+    flush_interval seconds have passed.
+    """
+    def __init__(self, filename=None, db=None, batch_size=1000,
+                 flush_interval=5):
+        from db import ExperimentDB, encode_arguments
+        if db is None:
+            db = ExperimentDB(filename)
+        self.encode_arguments = encode_arguments
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # seconds
+        self.run = None
+        # running calls as
+        # [seq, parent, name, start, stop, args, fp, key, stored]
+        self.stack = []
+        self.pending = []
+        self.call_count = 0
+        self.last_flush = time.time()
+
+    def flush(self):
+        if self.pending:
+            self.db.add_stage_calls(self.run, self.pending)
+            self.pending = []
+        self.last_flush = time.time()
+
+    def experiment_created_event(self, name, options):
+        self.run = self.db.add_run(name, options)
+
+    def experiment_mainfile_found_event(self, mainfile, doc):
+        self.db.update_run(self.run, mainfile=mainfile)
+
+    def experiment_started_event(self, start_time, seed, args, kwargs):
+        self.db.update_run(self.run, seed=seed, start_time=start_time)
+
+    def experiment_completed_event(self, stop_time, result):
+        self.flush()
+        self.db.update_run(self.run, stop_time=stop_time, result=result)
+
+    def stage_started_event(self, name, start_time, arguments):
+        parent = self.stack[-1][0] if self.stack else None
+        self.stack.append([self.call_count, parent, name, start_time, None,
+                           self.encode_arguments(
+                               {k: v for k, v in arguments.items()
+                                if k != 'logger'}), None, None, False])
+        self.call_count += 1
+
+    def stage_key_event(self, name, fingerprint, key, stored):
+        self.stack[-1][6:] = fingerprint, key, stored
+
+    def stage_completed_event(self, stop_time):
+        call = self.stack.pop()
+        call[4] = stop_time
+        self.pending.append(tuple(call))
+        if len(self.pending) >= self.batch_size or \
+           time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+
 def _datetimeformat(value, format='%H:%M / %d-%m-%Y'):
     return time.strftime(format, time.localtime(value))
 
 def _timedeltaformat(value):
-    return str(datetime.timedelta(seconds=value))
+    try:
+        return str(datetime.timedelta(seconds=value))
+    except TypeError:
+        return "not finished"
 
 class JinjaReporter(CompleteReporter):
-    def __init__(self):
+    """
+    Writes an rst report of the experiment. The template is streamed to a
+    temporary file that then replaces the report, so the report is never
+    half written. With a checkpoint_interval (in seconds) the report of
+    the unfinished experiment is rewritten at most that often while it
+    runs. Only the first max_call_details stage calls are described in
+    detail (all of them if it is None); the report only counts the
+    remaining ones.
+    """
+    def __init__(self, checkpoint_interval=None, max_call_details=1000):
         super(JinjaReporter, self).__init__()
-        from jinja2 import Environment
+        from jinja2 import Environment, PackageLoader
         self.env = Environment(loader=PackageLoader('mlizard', 'templates'))
         self.env.filters['datetime'] = _datetimeformat
         self.env.filters['timedelta'] = _timedeltaformat
+        self.checkpoint_interval = checkpoint_interval
+        self.max_call_details = max_call_details
+        self.last_checkpoint = time.time()
 
-    def experiment_completed_event(self, stop_time, result):
-        CompleteReporter.experiment_completed_event(self, stop_time, result)
-        t = self.env.get_template("rstReport.jinja2")
-        r = t.render(experiment=self.experiment_entry)
+    def report_path(self):
         if 'report_filename' in self.experiment_entry:
-            path = self.experiment_entry['report_filename']
-        else:
+            return self.experiment_entry['report_filename']
+        elif 'mainfile' in self.experiment_entry:
             # replace the trailing '.py' with '.report'
-            path = self.experiment_entry['mainfile'][:-3] + '.report'
-        with open(path, 'w') as outf:
-            outf.write(r)
+            return self.experiment_entry['mainfile'][:-3] + '.report'
+
+    def write_report(self, path, called=None):
+        experiment = dict(self.experiment_entry)
+        if called is None:
+            called = self.build_call_tree(self.max_call_details)
+        experiment['called'] = called
+        if self.max_call_details is None:
+            experiment['omitted_calls'] = 0
+        else:
+            experiment['omitted_calls'] = max(0, len(self.calls) -
+                                                 self.max_call_details)
+        t = self.env.get_template("rstReport.jinja2")
+        tmp_path = path + '.tmp'
+        t.stream(experiment=experiment).dump(tmp_path, encoding='utf-8')
+        os.rename(tmp_path, path)
+
+    def checkpoint(self):
+        if self.checkpoint_interval is None or \
+           time.time() - self.last_checkpoint < self.checkpoint_interval:
+            return
+        path = self.report_path()
+        if path is not None:
+            self.write_report(path)
+        self.last_checkpoint = time.time()
+
+    def experiment_completed_event(self, stop_time, result):
+        CompleteReporter.experiment_completed_event(self, stop_time, result)
+        path = self.report_path()
+        if path is None:
+            raise KeyError("Neither report_filename nor mainfile are known.")
+        # the (capped) tree was just built by CompleteReporter
+        self.write_report(path, self.experiment_entry['called'])
+
+    def stage_completed_event(self, stop_time):
+        CompleteReporter.stage_completed_event(self, stop_time)
+        self.checkpoint()
 
@@ -5,11 +5,30 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import division, print_function, unicode_literals
+import ast
+from collections import defaultdict
 from copy import copy
 import numpy as np
 import inspect
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import textwrap
+import threading
 import time
+import weakref
 from log import StageFunctionLoggerFacade, ResultLogHandler
+from caches import digest
+import parallel
+from profiling import StageStatistics
+
+RANDOM_SEED_RANGE = 0, 1000000
+
+# all stage functions by their qualified name (module.name)
+_stage_registry = weakref.WeakValueDictionary()
+# incremented whenever some stage learns about a new dependency
+_dependency_generation = [0]
+# per thread stack of the sets of stages called by the running stages
+_call_stack = threading.local()
 
 
 class StageFunction(object):
@@ -31,11 +50,34 @@ class StageFunction(object):
         self.__doc__ = f.__doc__
         # extract extra info
         self.source = str(inspect.getsource(f))
+        # used for the cache key so editing comments keeps cached results
+        self.fingerprint = digest(normalize_source(self.source))
+        self.qualified_name = "{}.{}".format(f.__module__, name)
+        _stage_registry[self.qualified_name] = self
+        # qualified names of stages that were observed being called from
+        # this stage (loaded from the cache lazily)
+        self.called_stages = None
+        # generation, fingerprint, names of known dependencies
+        self.dependency_fingerprint = None, None, None
         self.signature = get_signature(f)
         if self.signature['varargs_name'] :
             raise TypeError("*args not supported by StageFunction")
         if self.signature['kw_wildcard_name'] :
             raise TypeError("**kwargs not supported by StageFunction")
+        # precompiled for fast calls
+        self.binder = ArgumentBinder(self.signature)
+        self.takes_rnd = 'rnd' in self.signature['args']
+        self.takes_logger = 'logger' in self.signature['args']
+        self.takes_checkpoint = 'checkpoint' in self.signature['args']
+        self.logger_facade = StageFunctionLoggerFacade(self.message_logger,
+                                                       self.results_logger)
+        # reused by all calls that don't overlap with another call and
+        # attached for the lifetime of the stage (only if it can log results)
+        self.results_handler = ResultLogHandler()
+        self.results_handler_lock = threading.Lock()
+        if self.takes_logger:
+            self.results_logger.addHandler(self.results_handler)
+        self.statistics = StageStatistics(name)
         self.emit_created()
 
     def emit_created(self):
@@ -52,6 +94,14 @@ class StageFunction(object):
             except AttributeError:
                 pass
 
+    def emit_key(self, key, stored):
+        for o in self.observers:
+            try:
+                o.stage_key_event(self.__name__, self.fingerprint, key,
+                                  stored)
+            except AttributeError:
+                pass
+
     def emit_completed(self, stop_time):
         for o in self.observers:
             try:
@@ -61,76 +111,362 @@ class StageFunction(object):
 
 
     def add_random_arg_to(self, arguments):
-        if 'rnd' in self.signature['args']  and 'rnd' not in arguments:
+        if self.takes_rnd and 'rnd' not in arguments:
             arguments['rnd'] = self.random
 
     def add_logger_arg_to(self, arguments):
-        l = StageFunctionLoggerFacade(self.message_logger, self.results_logger)
-        if 'logger' in self.signature['args']:
-            arguments['logger'] = l
+        if self.takes_logger:
+            arguments['logger'] = self.logger_facade
 
 
+    def add_checkpoint_arg_to(self, arguments):
+        # replaced by the StageCheckpoint once the cache key is known
+        if self.takes_checkpoint:
+            arguments['checkpoint'] = None
+
     def construct_arguments(self, args, kwargs, options):
-        assert_no_unexpected_kwargs(self.signature, kwargs)
-        assert_no_duplicate_args(self.signature, args, kwargs)
-        arguments = apply_options(self.signature, args, kwargs, options)
+        arguments = self.binder.bind(args, kwargs, options)
         self.add_random_arg_to(arguments)
         self.add_logger_arg_to(arguments)
-        assert_no_missing_args(self.signature, arguments)
+        self.add_checkpoint_arg_to(arguments)
+        if len(arguments) < self.binder.nr_args:
+            assert_no_missing_args(self.signature, arguments)
         return arguments
 
     def get_key(self, arguments):
-        # use arguments without logger as cache-key
+        # use arguments without logger and checkpoint as cache-key
         a = copy(arguments)
         if 'logger' in arguments: del a['logger']
-        #todo really hash this so key can easily be stored in db
-        return self.source, a
+        if 'checkpoint' in arguments: del a['checkpoint']
+        # hash deterministically so the key is stable across processes
+        return digest((self.fingerprint, self.get_dependency_fingerprint(), a))
+
+    def expected_key(self, options, args=(), kwargs=None):
+        """
+        The cache key of a call with the given arguments and options, or None
+        if it can't be known in advance: if the stage takes rnd (its state
+        depends on the previous calls) or if arguments are missing.
+        """
+        if self.takes_rnd or not (self.cache and self.do_cache_results):
+            return None
+        try:
+            arguments = self.construct_arguments(args, kwargs or {}, options)
+        except TypeError:
+            return None
+        return self.get_key(arguments)
+
+    def get_dependency_fingerprint(self):
+        """
+        Digest of the fingerprints of all stages and module-level helper
+        functions this stage (indirectly) references or was observed to call.
+        """
+        if self.called_stages is None:
+            self.load_called_stages()
+        generation, fingerprint, names = self.dependency_fingerprint
+        if generation != _dependency_generation[0]:
+            dependencies = collect_dependencies(self)
+            names = set(dependencies)
+            del dependencies[self.qualified_name]
+            fingerprint = digest(dependencies)
+            self.dependency_fingerprint = (_dependency_generation[0],
+                                           fingerprint, names)
+        return fingerprint
+
+    def load_called_stages(self):
+        self.called_stages = set()
+        if self.cache:
+            try:
+                self.called_stages = set(self.cache[('called_stages',
+                                                     self.fingerprint)])
+            except KeyError:
+                pass
+
+    def learn_called_stages(self, called):
+        """
+        Remember stages that were called but are not known dependencies yet.
+        Returns True if any were new.
+        """
+        self.get_dependency_fingerprint()
+        new_stages = called - self.dependency_fingerprint[2]
+        if not new_stages:
+            return False
+        self.called_stages |= new_stages
+        _dependency_generation[0] += 1
+        if self.cache:
+            # only bookkeeping, so a cache rejecting it must not fail the call
+            try:
+                self.cache[('called_stages', self.fingerprint)] = \
+                    sorted(self.called_stages)
+            except Exception:
+                self.message_logger.warning("Could not cache the called "
+                                            "stages.", exc_info=True)
+        return True
+
 
 
     def execute_function(self, args, kwargs, options):
+        frames = _call_frames()
+        if frames:
+            # this is a nested call: let the calling stage know
+            frames[-1].add(self.qualified_name)
         arguments = self.construct_arguments(args, kwargs, options)
         self.message_logger.debug("Called with %s", arguments)
-        key = self.get_key(arguments)
+        # do we want to cache?
+        caching = self.cache and self.do_cache_results
+        key = self.get_key(arguments) if caching else None
+        if self.takes_checkpoint:
+            arguments['checkpoint'] = StageCheckpoint(
+                self.cache if caching else None, key,
+                arguments.get('rnd', self.random), self.message_logger)
         start_time = time.time()
+        start_cpu_time = time.clock()
         self.emit_started(start_time, arguments)
-        # do we want to cache?
-        if self.cache and self.do_cache_results:
+        reserved = False
+        if caching:
             # Check for cached version
             try:
-                result, result_logs = self.cache[key]
-                arguments['logger'].set_result(**result_logs)
-                self.message_logger.info("Retrieved results from cache. "
-                                         "Skipping Execution")
-                stop_time = time.time()
-                self.emit_completed(stop_time)
-                return result
+                return self.retrieve_result(key, start_time, start_cpu_time)
             except KeyError:
                 pass
-        #### Run the function ####
-        local_results_handler = ResultLogHandler()
-        self.results_logger.addHandler(local_results_handler)
-        result = self.function(**arguments) #<<=====
-        result_logs = local_results_handler.results
-        self.results_logger.removeHandler(local_results_handler)
+            if hasattr(self.cache, 'reserve'):
+                # blocks while another process computes the same result
+                reserved = self.cache.reserve(key)
+                if not reserved:
+                    try:
+                        return self.retrieve_result(key, start_time,
+                                                    start_cpu_time)
+                    except KeyError:
+                        pass
+        reserved_key = key
+        try:
+            #### Run the function ####
+            if not self.takes_logger:
+                local_results_handler = None # nothing can be logged
+            elif self.results_handler_lock.acquire(False):
+                local_results_handler = self.results_handler
+                local_results_handler.results = defaultdict(list)
+            else:
+                # recursive or concurrent call
+                local_results_handler = ResultLogHandler()
+                self.results_logger.addHandler(local_results_handler)
+            frames.append(set())
+            try:
+                if self.statistics.profiling:
+                    result = self.statistics.run_profiled(self.function,
+                                                          arguments)
+                else:
+                    result = self.function(**arguments) #<<=====
+            finally:
+                called = frames.pop()
+                if local_results_handler is None:
+                    result_logs = defaultdict(list)
+                else:
+                    result_logs = local_results_handler.results
+                if local_results_handler is self.results_handler:
+                    # the handler stays attached, so later logs (e.g. of
+                    # cache hits) must not end up in these result_logs
+                    local_results_handler.results = defaultdict(list)
+                    self.results_handler_lock.release()
+                elif local_results_handler is not None:
+                    self.results_logger.removeHandler(local_results_handler)
+            if caching and self.learn_called_stages(called):
+                # the key has to include the newly found dependencies
+                key = self.get_key(arguments)
+            stop_time = time.time()
+            exec_time = stop_time - start_time
+            self.statistics.add_call(exec_time, time.clock() - start_cpu_time,
+                                     False if caching else None)
+            self.message_logger.info("Completed in %2.2f sec", exec_time)
+            if caching:
+                stored = self.store_result(key, (result, result_logs),
+                                           exec_time)
+                self.emit_key(key, stored)
+            self.emit_completed(stop_time)
+            ##########################
+            if self.takes_checkpoint:
+                arguments['checkpoint'].clear()
+        finally:
+            if reserved:
+                self.cache.release(reserved_key)
+        return result
+
+    def retrieve_result(self, key, start_time, start_cpu_time):
+        value = self.cache[key]
+        result, result_logs = value
+        self.logger_facade.set_result(**result_logs)
+        self.message_logger.info("Retrieved results from cache. "
+                                 "Skipping Execution")
         stop_time = time.time()
-        exec_time = stop_time - start_time
-        self.message_logger.info("Completed in %2.2f sec", exec_time)
+        self.statistics.add_call(stop_time - start_time,
+                                 time.clock() - start_cpu_time, True)
+        self.count_bytes('bytes_read', key)
+        self.emit_key(key, True)
         self.emit_completed(stop_time)
-        ##########################
-        if self.cache and self.do_cache_results and \
-           exec_time > self.caching_threshold:
+        return result
+
+    def store_result(self, key, value, exec_time):
+        """Cache the value if it is worth it and return whether it was."""
+        if hasattr(self.cache, 'offer'):
+            # the cache has its own admission policy
+            if not self.cache.offer(key, value, exec_time):
+                return False
+            self.message_logger.info("Cached the result.")
+        elif exec_time > self.caching_threshold:
             self.message_logger.info("Execution took more than %2.2f sec so we "
                                      "cache the result."%self.caching_threshold)
-            self.cache[key] = result, result_logs
-        return result
+            self.cache[key] = value
+        else:
+            return False
+        self.count_bytes('bytes_written', key)
+        return True
+
+    def count_bytes(self, counter, key):
+        # only caches that know the size of their entries (see entry_size)
+        # are accounted, so values never have to be pickled just to count
+        entry_size = getattr(self.cache, 'entry_size', None)
+        size = entry_size(key) if entry_size is not None else None
+        if size is not None:
+            setattr(self.statistics, counter,
+                    getattr(self.statistics, counter) + size)
 
     def __call__(self, *args, **kwargs):
         return self.execute_function(args, kwargs, self.options)
 
+    def repeat(self, n, args=(), kwargs=None, workers=1, pool='thread'):
+        """
+        Run this stage n times and return the RunningStatistics (mean and
+        variance) of the results, without keeping all the results in memory.
+        Every repetition gets its own rnd seeded with a seed derived from the
+        stage seed, so the statistics are reproducible.
+        With workers > 1 the repetitions run in a pool of threads or (with
+        pool='process') of forked processes. Note that results logged by
+        concurrent threads end up in the result logs of each other.
+        """
+        kwargs = kwargs or {}
+        seed_rng = np.random.RandomState(self.seed)
+        seeds = seed_rng.randint(*RANDOM_SEED_RANGE, size=n)
+        jobs = [(seed, args, kwargs) for seed in seeds]
+        stats = RunningStatistics()
+        if workers <= 1:
+            for job in jobs:
+                stats.update(self.run_repetition(job))
+            return stats
+        if pool == 'thread':
+            p = ThreadPool(workers)
+            run = self.run_repetition
+        elif pool == 'process':
+            parallel.worker_state['stage'] = self
+            p = multiprocessing.Pool(workers)
+            run = parallel.run_repetition
+        else:
+            raise ValueError("Unknown pool type '{}'".format(pool))
+        try:
+            # imap keeps the order, so the statistics are deterministic
+            for result in p.imap(run, jobs):
+                stats.update(result)
+        finally:
+            p.close()
+            p.join()
+            parallel.worker_state.pop('stage', None)
+        return stats
+
+    def run_repetition(self, job):
+        seed, args, kwargs = job
+        kwargs = dict(kwargs)
+        if 'rnd' in self.signature['args']:
+            kwargs['rnd'] = np.random.RandomState(seed)
+        return self.execute_function(args, kwargs, self.options)
+
     def __hash__(self):
         return hash(self.source)
 
 
+class StageCheckpoint(object):
+    """
+    Passed to stages that take a 'checkpoint' argument. The stage can save
+    its intermediate state, which is stored in the cache under the key of
+    the call together with the state of rnd. If the call is interrupted,
+    the next call with the same arguments can load the state (which also
+    restores rnd) and resume from there. The checkpoint is deleted once the
+    stage completes. Without a cache saving does nothing.
+    Saving never raises: if the cache rejects the checkpoint (e.g. a
+    BoundedCache that has no room for it), this is logged and the stage
+    just goes on without it.
+    Note that results logged before the interruption are not restored.
+    """
+    def __init__(self, cache, key, rnd, logger=None):
+        self.cache = cache
+        self.key = ('checkpoint', key)
+        self.rnd = rnd
+        self.logger = logger
+
+    def save(self, state):
+        """Save the state and return whether that worked."""
+        if not self.cache:
+            return False
+        try:
+            self.cache[self.key] = state, self.rnd.get_state()
+            if hasattr(self.cache, 'sync'):
+                self.cache.sync()
+        except Exception:
+            if self.logger is not None:
+                self.logger.warning("Could not save the checkpoint.",
+                                    exc_info=True)
+            return False
+        return True
+
+    def load(self, default=None):
+        """
+        Return the last saved state and restore rnd to the state it had at
+        that time, or return default if there is no checkpoint.
+        """
+        if not self.cache:
+            return default
+        try:
+            state, rnd_state = self.cache[self.key]
+        except KeyError:
+            return default
+        self.rnd.set_state(rnd_state)
+        return state
+
+    def clear(self):
+        if not self.cache:
+            return
+        try:
+            del self.cache[self.key]
+        except KeyError:
+            pass
+
+    def __repr__(self):
+        return "<StageCheckpoint>"
+
+
+class RunningStatistics(object):
+    """
+    Streaming mean and variance (Welford's algorithm) of scalars or arrays.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        self.n += 1
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.n
+        self.m2 = self.m2 + delta * (x - self.mean)
+
+    @property
+    def var(self):
+        """Population variance (like numpy.var)."""
+        return self.m2 / self.n if self.n else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
 class StageFunctionOptionsView(object):
     def __init__(self, stage_func, options):
         self.options = options
@@ -140,6 +476,135 @@ class StageFunctionOptionsView(object):
         return self.func.execute_function(args, kwargs, self.options)
 
 
+def normalize_source(source):
+    """
+    Return a representation of the given source code that is independent of
+    comments, docstrings and formatting: a dump of its AST without the
+    docstrings. Falls back to the source itself if it can't be parsed.
+    """
+    try:
+        tree = ast.parse(textwrap.dedent(source))
+    except SyntaxError:
+        return source
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef)) and \
+           node.body and isinstance(node.body[0], ast.Expr) and \
+           isinstance(node.body[0].value, ast.Str):
+            node.body = node.body[1:] or [ast.Pass()]
+    return ast.dump(tree)
+
+
+def _call_frames():
+    if not hasattr(_call_stack, 'frames'):
+        _call_stack.frames = []
+    return _call_stack.frames
+
+
+_source_fingerprints = dict()
+
+
+def _function_fingerprint(f):
+    code = f.__code__
+    if code not in _source_fingerprints:
+        try:
+            source = inspect.getsource(f)
+            _source_fingerprints[code] = digest(normalize_source(source))
+        except (IOError, TypeError):
+            _source_fingerprints[code] = None
+    return _source_fingerprints[code]
+
+
+def referenced_objects(f):
+    """
+    Yield the global objects and closure variables that the code of function
+    f (including nested functions) refers to by name.
+    """
+    codes = [f.__code__]
+    names = set()
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(c for c in code.co_consts if inspect.iscode(c))
+    for name in sorted(names):
+        if name in f.__globals__:
+            yield f.__globals__[name]
+    for cell in f.__closure__ or ():
+        try:
+            yield cell.cell_contents
+        except ValueError:
+            pass # empty cell
+
+
+def collect_dependencies(stage, dependencies=None):
+    """
+    Collect the fingerprints of the given stage and all the stages and
+    helper functions (from the same module) it depends on: Those referenced
+    by its code and those it was observed calling. Unresolvable stages are
+    included with a fingerprint of None.
+    Returns a dict qualified_name -> fingerprint.
+    """
+    if dependencies is None:
+        dependencies = dict()
+    dependencies[stage.qualified_name] = stage.fingerprint
+    if stage.called_stages is None:
+        stage.load_called_stages()
+    for name in stage.called_stages:
+        if name not in dependencies:
+            if name in _stage_registry:
+                collect_dependencies(_stage_registry[name], dependencies)
+            else:
+                dependencies[name] = None
+    _collect_function_dependencies(stage.function, dependencies)
+    return dependencies
+
+
+def _collect_function_dependencies(f, dependencies):
+    for obj in referenced_objects(f):
+        if isinstance(obj, StageFunction):
+            if obj.qualified_name not in dependencies:
+                collect_dependencies(obj, dependencies)
+        elif isinstance(obj, StageFunctionOptionsView):
+            if obj.func.qualified_name not in dependencies:
+                collect_dependencies(obj.func, dependencies)
+        elif inspect.isfunction(obj) and obj.__module__ == f.__module__:
+            name = "{}.{}".format(obj.__module__, obj.__name__)
+            if name not in dependencies:
+                dependencies[name] = _function_fingerprint(obj)
+                _collect_function_dependencies(obj, dependencies)
+
+
+class ArgumentBinder(object):
+    """
+    Precompiled version of apply_options and the argument checks for one
+    signature. The (slow) checks that produce the error messages only run
+    if something is wrong.
+    """
+    def __init__(self, signature):
+        self.signature = signature
+        self.args = tuple(signature['args'])
+        self.arg_set = frozenset(self.args)
+        self.nr_args = len(self.args)
+        self.defaults = dict(signature['kwargs'])
+
+    def bind(self, args, kwargs, options):
+        if kwargs:
+            for k in kwargs:
+                if k not in self.arg_set:
+                    assert_no_unexpected_kwargs(self.signature, kwargs)
+            if args:
+                assert_no_duplicate_args(self.signature, args, kwargs)
+        if len(args) > self.nr_args:
+            raise TypeError("{}() takes at most {} arguments ({} given)".format(
+                self.signature['name'], self.nr_args, len(args)))
+        arguments = self.defaults.copy()  # weakest: default arguments
+        for v in self.args:
+            if v in options:
+                arguments[v] = options[v]
+        arguments.update(kwargs)  # keyword arguments
+        arguments.update(zip(self.args, args))  # strongest: positional
+        return arguments
+
+
 def get_signature(f):
     args, varargs_name, kw_wildcard_name, defaults = inspect.getargspec(f)
     defaults = defaults or []
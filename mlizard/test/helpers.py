@@ -6,6 +6,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import division, unicode_literals, print_function
 
+import pickle
+import time
+
 from nose.tools import istest, nottest, with_setup
 from nose.tools import assert_true as _assert_true
 from nose.tools import assert_not_equal as _assert_not_equal
@@ -19,5 +22,31 @@ def assert_true(expr, msg=None):
 def assert_not_equal(first, second, msg=None):
     _assert_not_equal(first, second, msg)
 
+class DictCache(dict):
+    """In-memory cache for tests. Unlike a dict it is true even if empty."""
+    def sync(self):
+        pass
+
+    def __nonzero__(self):
+        return True
+
+class CountingCache(DictCache):
+    """Stores pickled values like a persistent cache and counts reads."""
+    def __init__(self):
+        super(CountingCache, self).__init__()
+        self.reads = 0
+
+    def __getitem__(self, item):
+        self.reads += 1
+        return pickle.loads(super(CountingCache, self).__getitem__(item))
+
+    def __setitem__(self, key, value):
+        super(CountingCache, self).__setitem__(key, pickle.dumps(value))
+
+class SlowCountingCache(CountingCache):
+    def __getitem__(self, item):
+        time.sleep(0.05)
+        return super(SlowCountingCache, self).__getitem__(item)
+
 # Use the same flag as unittest itself to prevent descent into these functions:
 __unittest = 1
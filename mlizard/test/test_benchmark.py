@@ -0,0 +1,38 @@
+#!/usr/bin/python
+# coding=utf-8
+# This file is part of the MLizard library published under the GPL3 license.
+# Copyright (C) 2012  Klaus Greff
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, print_function, unicode_literals
+
+from helpers import *
+from ..benchmark import BENCHMARKS, compare, run_benchmarks, time_function
+from ..benchmark import stage_call_cache_hit
+
+
+def test_time_function_reports_time_per_call():
+    result = time_function(lambda: None, repeat=3, min_time=0.001)
+    assert_equal(result['repeat'], 3)
+    assert_true(result['best'] <= result['median'])
+    assert_true(result['number'] > 1)
+
+
+def test_run_benchmarks_runs_matching_benchmarks():
+    results = run_benchmarks('[10]', repeat=1, min_time=0.001)
+    expected = [name for name, setup, size in BENCHMARKS if '[10]' in name]
+    assert_equal(sorted(results['results']), sorted(expected))
+
+
+def test_compare_reports_regressions():
+    baseline = {'results': {'a': {'best': 1.0}, 'b': {'best': 1.0}}}
+    results = {'results': {'a': {'best': 1.1}, 'b': {'best': 2.0},
+                           'c': {'best': 5.0}}}
+    assert_equal(compare(results, baseline, tolerance=1.25), [('b', 2.0)])
+
+
+def test_cache_hit_benchmark_hits_the_cache():
+    call = stage_call_cache_hit(10)
+    call()
+    call()
+    assert_equal(call.stage.statistics.cache_hits, 2)
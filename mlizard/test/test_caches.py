@@ -7,9 +7,19 @@
 from __future__ import division, print_function, unicode_literals
 
 import numpy as np
-from tempfile import NamedTemporaryFile
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from tempfile import NamedTemporaryFile, mkdtemp
 
-from mlizard.caches import ShelveCache
+from mlizard.caches import ShelveCache, ArrayStoreCache, BoundedCache
+from mlizard.caches import TieredCache, EncodedValue, SQLiteCache
+from mlizard.caches import pickled_size
+from mlizard import caches
 from helpers import *
 
 def foonction():
@@ -48,4 +58,314 @@ def test_ShelveCache_stores_arbitrary_values():
             cache[k] = v
 
         for k,v in key_value_pairs:
-            assert_equal(cache[k], v)
\ No newline at end of file
+            assert_equal(cache[k], v)
+
+def test_ArrayStoreCache_returns_memory_mapped_arrays():
+    directory = mkdtemp()
+    try:
+        cache = ArrayStoreCache(directory)
+        a = np.arange(1000.)
+        cache['foo'] = a, {'b' : np.ones((20, 30)), 'c' : 7}
+        r, logs = cache['foo']
+        assert_true(isinstance(r, np.memmap))
+        assert_equal(r, a)
+        assert_true(isinstance(logs['b'], np.memmap))
+        assert_equal(logs['b'], np.ones((20, 30)))
+        assert_equal(logs['c'], 7)
+        del cache, r, logs
+    finally:
+        shutil.rmtree(directory)
+
+def test_ArrayStoreCache_stores_arbitrary_values():
+    directory = mkdtemp()
+    try:
+        cache = ArrayStoreCache(directory)
+        key_value_pairs = zip(range(len(TEST_OBJECTS)), TEST_OBJECTS)
+        for k, v in key_value_pairs:
+            cache[k] = v
+
+        for k,v in key_value_pairs:
+            assert_equal(cache[k], v)
+        del cache
+    finally:
+        shutil.rmtree(directory)
+
+def test_ArrayStoreCache_delete_removes_array_files():
+    directory = mkdtemp()
+    try:
+        cache = ArrayStoreCache(directory)
+        cache['foo'] = np.zeros(1000)
+        assert_equal(len([f for f in os.listdir(directory)
+                          if f.endswith('.npy')]), 1)
+        del cache['foo']
+        assert_equal(len([f for f in os.listdir(directory)
+                          if f.endswith('.npy')]), 0)
+        assert_equal(len(cache.index), 0)
+        del cache
+    finally:
+        shutil.rmtree(directory)
+
+def test_ArrayStoreCache_overwrites_without_breaking_readers():
+    directory = mkdtemp()
+    try:
+        cache = ArrayStoreCache(directory)
+        cache['foo'] = np.zeros(1000)
+        old = cache['foo']
+        old_files = set(os.listdir(directory))
+        cache['foo'] = np.ones(1000)
+        assert_equal(cache['foo'], np.ones(1000))
+        # the old array stays valid while it is mapped
+        assert_equal(old, np.zeros(1000))
+        npy_files = [f for f in os.listdir(directory) if f.endswith('.npy')]
+        assert_equal(len(npy_files), 1)
+        assert_true(npy_files[0] not in old_files)
+        del cache, old
+    finally:
+        shutil.rmtree(directory)
+
+@raises(KeyError)
+def test_ArrayStoreCache_missing_array_files_raise_KeyError():
+    directory = mkdtemp()
+    try:
+        cache = ArrayStoreCache(directory)
+        cache['foo'] = np.zeros(1000)
+        for f in os.listdir(directory):
+            if f.endswith('.npy'):
+                os.remove(os.path.join(directory, f))
+        cache['foo']
+    finally:
+        # the KeyError's traceback keeps the cache alive, so close it
+        cache.close()
+        del cache
+        shutil.rmtree(directory)
+
+def test_ArrayStoreCache_close_writes_the_index():
+    directory = mkdtemp()
+    try:
+        cache = ArrayStoreCache(directory)
+        cache['foo'] = np.arange(1000.)
+        cache.close()
+        cache.close()
+        assert_equal(ArrayStoreCache(directory)['foo'], np.arange(1000.))
+        # a cache whose directory is gone can still be garbage collected
+        cache = ArrayStoreCache(os.path.join(directory, 'sub'))
+        shutil.rmtree(os.path.join(directory, 'sub'))
+        cache.__del__()
+    finally:
+        shutil.rmtree(directory)
+
+
+
+def test_pickled_size_counts_arrays_by_nbytes():
+    a = np.zeros(1000)
+    plain = [1, 'two', {'three': 3}]
+    assert_equal(pickled_size(a), 8000)
+    assert_equal(pickled_size(plain),
+                 len(pickle.dumps(plain, pickle.HIGHEST_PROTOCOL)))
+    nested = pickled_size((a, {'a': [a, 'b']}))
+    assert_true(16000 < nested < 16100)
+
+def test_BoundedCache_evicts_least_recently_used():
+    cache = BoundedCache(DictCache(), max_bytes=2000, min_exec_time=0)
+    assert_true(cache.offer('a', np.zeros(100), 1))
+    assert_true(cache.offer('b', np.zeros(100), 1))
+    cache['a']
+    assert_true(cache.offer('c', np.zeros(100), 1))
+    assert_true('a' in cache.cache)
+    assert_true('b' not in cache.cache)
+    assert_true('c' in cache.cache)
+    assert_true(cache.total_bytes <= 2000)
+
+def test_BoundedCache_rejects_fast_or_too_large_results():
+    cache = BoundedCache(DictCache(), max_bytes=1000, min_exec_time=2)
+    assert_true(not cache.offer('a', 1, 1))
+    assert_true(not cache.offer('b', np.zeros(1000), 10))
+    assert_true(cache.offer('c', 1, 10))
+
+def test_BoundedCache_cost_policy_keeps_expensive_entries():
+    cache = BoundedCache(DictCache(), max_bytes=1000, policy='cost',
+                         min_exec_time=0)
+    assert_true(cache.offer('expensive', np.zeros(100), 100))
+    assert_true(not cache.offer('cheap', np.zeros(100), 1))
+    assert_true(cache.offer('more_expensive', np.zeros(100), 200))
+    assert_equal(sorted(cache.cache.keys()),
+                 [BoundedCache.INDEX_KEY, 'more_expensive'])
+
+def test_BoundedCache_restores_index_from_wrapped_cache():
+    backend = DictCache()
+    cache = BoundedCache(backend, max_bytes=10000, min_exec_time=0)
+    cache.offer('a', np.zeros(100), 3)
+    cache2 = BoundedCache(backend, max_bytes=10000, min_exec_time=0)
+    assert_equal(cache2.total_bytes, 800)
+
+def test_TieredCache_serves_hits_from_memory():
+    backend = CountingCache()
+    cache = TieredCache(backend)
+    cache['a'] = 1
+    assert_true('a' in backend)
+    assert_equal(cache['a'], 1)
+    assert_equal(cache['a'], 1)
+    assert_equal(backend.reads, 0)
+
+def test_TieredCache_leaves_admission_to_stages_without_backend_policy():
+    assert_true(not hasattr(TieredCache(DictCache()), 'offer'))
+    bounded = BoundedCache(DictCache(), max_bytes=1000, min_exec_time=1)
+    cache = TieredCache(bounded)
+    assert_true(not cache.offer('a', 1, 0.5))
+    assert_true(cache.offer('a', 1, 2))
+    assert_equal(cache['a'], 1)
+
+def test_TieredCache_loads_misses_from_backend():
+    backend = CountingCache()
+    backend['a'] = 1
+    cache = TieredCache(backend)
+    assert_equal(cache['a'], 1)
+    assert_equal(cache['a'], 1)
+    assert_equal(backend.reads, 1)
+
+def test_TieredCache_bounds_memory_tier():
+    cache = TieredCache(DictCache(), max_entries=2)
+    for k in 'abc':
+        cache[k] = k
+    assert_equal(len(cache.memory), 2)
+    assert_equal(cache['a'], 'a')
+
+def test_TieredCache_references_large_values_weakly():
+    backend = CountingCache()
+    cache = TieredCache(backend, weak_threshold=100)
+    a = np.zeros(1000)
+    cache['a'] = (a, {'loss' : [1, 2]})
+    r, logs = cache['a']
+    assert_true(r is a)
+    assert_equal(backend.reads, 0)
+    del a, r
+    cache['a']
+    assert_equal(backend.reads, 1)
+
+def test_TieredCache_prefetch_loads_values_into_memory():
+    backend = SlowCountingCache()
+    backend['a'] = 1
+    backend['b'] = 2
+    cache = TieredCache(backend)
+    cache.prefetch(['a', 'b', 'c'])
+    # the lookup waits for the running prefetch instead of reading again
+    assert_equal(cache['b'], 2)
+    while cache.pending:
+        time.sleep(0.01)
+    assert_equal(backend.reads, 3)
+    assert_equal(len(cache.memory), 2)
+    assert_equal(cache['a'], 1)
+    assert_equal(backend.reads, 3)
+
+def test_ShelveCache_compresses_large_values():
+    directory = mkdtemp()
+    try:
+        cache = ShelveCache(os.path.join(directory, 'cache'), codec='zlib',
+                            compression_threshold=1000)
+        cache['small'] = [1, 2, 3]
+        cache['large'] = np.zeros(10000), {'loss' : range(100)}
+        small = cache.shelve[cache.transform_key('small')]
+        large = cache.shelve[cache.transform_key('large')]
+        assert_equal(small.codec, None)
+        assert_equal(large.codec, 'zlib')
+        assert_true(len(large.data) < 10000)
+        assert_equal(cache['small'], [1, 2, 3])
+        r, logs = cache['large']
+        assert_equal(r, np.zeros(10000))
+        assert_equal(logs, {'loss' : range(100)})
+        del cache
+    finally:
+        shutil.rmtree(directory)
+
+@raises(ValueError)
+def test_caches_reject_codecs_with_missing_modules():
+    def missing_module():
+        raise ImportError("No module named blosc")
+
+    original = caches.CODEC_MODULES['blosc']
+    caches.CODEC_MODULES['blosc'] = missing_module
+    directory = mkdtemp()
+    try:
+        SQLiteCache(directory, codec='blosc')
+    finally:
+        caches.CODEC_MODULES['blosc'] = original
+        shutil.rmtree(directory)
+
+def test_ShelveCache_reads_entries_with_other_codecs():
+    directory = mkdtemp()
+    try:
+        filename = os.path.join(directory, 'cache')
+        cache = ShelveCache(filename)
+        cache['plain'] = 'foo'
+        cache['bz2'] = EncodedValue.encode('bar', 'bz2')
+        del cache
+        cache = ShelveCache(filename, codec='zlib')
+        assert_equal(cache['plain'], 'foo')
+        assert_equal(cache['bz2'], 'bar')
+        del cache
+    finally:
+        shutil.rmtree(directory)
+
+def test_SQLiteCache_stores_arbitrary_values():
+    directory = mkdtemp()
+    try:
+        cache = SQLiteCache(directory, codec='zlib')
+        key_value_pairs = zip(range(len(TEST_OBJECTS)), TEST_OBJECTS)
+        for k, v in key_value_pairs:
+            cache[k] = v
+
+        cache2 = SQLiteCache(directory)
+        for k,v in key_value_pairs:
+            assert_equal(cache2[k], v)
+        del cache[3]
+        assert_true(3 not in cache2)
+    finally:
+        shutil.rmtree(directory)
+
+def test_caches_report_known_entry_sizes():
+    directory = mkdtemp()
+    try:
+        sqlite_cache = SQLiteCache(directory)
+        sqlite_cache['a'] = np.zeros(1000)
+        assert_true(sqlite_cache.entry_size('a') >= 8000)
+        assert_equal(sqlite_cache.entry_size('b'), None)
+        tiered = TieredCache(sqlite_cache)
+        assert_equal(tiered.entry_size('a'), sqlite_cache.entry_size('a'))
+        bounded = BoundedCache(DictCache(), max_bytes=100000, min_exec_time=0)
+        bounded['a'] = np.zeros(1000)
+        assert_equal(bounded.entry_size('a'), 8000)
+        assert_equal(TieredCache(DictCache()).entry_size('a'), None)
+    finally:
+        shutil.rmtree(directory)
+
+def test_SQLiteCache_reserve_waits_for_inflight_computation():
+    directory = mkdtemp()
+    try:
+        cache = SQLiteCache(directory, poll_interval=0.01)
+        assert_true(cache.reserve('foo'))
+
+        def compute():
+            time.sleep(0.1)
+            cache['foo'] = 'bar'
+            cache.release('foo')
+        t = threading.Thread(target=compute)
+        t.start()
+        other_process_cache = SQLiteCache(directory, poll_interval=0.01)
+        assert_true(not other_process_cache.reserve('foo'))
+        assert_equal(other_process_cache['foo'], 'bar')
+        t.join()
+    finally:
+        shutil.rmtree(directory)
+
+def test_SQLiteCache_breaks_reservations_of_dead_processes():
+    directory = mkdtemp()
+    try:
+        cache = SQLiteCache(directory, poll_interval=0.01)
+        p = subprocess.Popen([sys.executable, '-c', 'pass'])
+        p.wait()
+        with cache.connection as c:
+            c.execute("INSERT INTO reservations VALUES (?, ?, ?)",
+                      (cache.transform_key('foo'), p.pid, time.time()))
+        assert_true(cache.reserve('foo'))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# coding=utf-8
+# This file is part of the MLizard library published under the GPL3 license.
+# Copyright (C) 2012  Klaus Greff
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, print_function, unicode_literals
+
+import numpy as np
+import os
+import shutil
+from tempfile import mkdtemp
+
+from helpers import *
+from ..caches import CacheStub, TieredCache
+from ..db import ExperimentDB, encode_arguments
+from ..experiment import Experiment
+from ..factory import NO_LOGGER
+from ..report import SQLiteReporter
+
+
+def setup_directory():
+    global directory
+    directory = mkdtemp()
+
+def remove_directory():
+    shutil.rmtree(directory)
+
+
+@with_setup(setup_directory, remove_directory)
+def test_ExperimentDB_finds_runs_by_options_and_time():
+    db = ExperimentDB(os.path.join(directory, 'experiments.sqlite'))
+    r1 = db.add_run('ex', {'a' : 1, 'sec' : {'b' : 'x'}}, start_time=10)
+    r2 = db.add_run('ex', {'a' : 2, 'sec' : {'b' : 'x'}}, start_time=20)
+    r3 = db.add_run('other', {'a' : 1}, start_time=30)
+    db.update_run(r2, stop_time=25, result=[1, np.arange(3)])
+    assert_equal(db.find_runs(options={'a' : 1}), [r1, r3])
+    assert_equal(db.find_runs(name='ex', options={'sec.b' : 'x'}), [r1, r2])
+    assert_equal(db.find_runs(started_after=15, started_before=30), [r2])
+    assert_equal(db.find_runs(completed=True), [r2])
+    run = db.get_run(r2)
+    assert_equal(run['result'][0], 1)
+    assert_equal(run['result'][1], np.arange(3))
+    assert_true(isinstance(run['result_summary'], basestring))
+    assert_equal(run['options'], {'a' : 2, 'sec.b' : 'x'})
+
+
+@with_setup(setup_directory, remove_directory)
+def test_ExperimentDB_matches_long_values_exactly():
+    db = ExperimentDB(os.path.join(directory, 'experiments.sqlite'))
+    prefix = '/data/' + 'x' * 100
+    r1 = db.add_run('ex', {'path' : prefix + '/a.npy', 'l' : [0] * 50 + [1]})
+    r2 = db.add_run('ex', {'path' : prefix + '/b.npy', 'l' : [0] * 50 + [2]})
+    assert_equal(db.find_runs(options={'path' : prefix + '/b.npy'}), [r2])
+    assert_equal(db.find_runs(options={'l' : [0] * 50 + [1]}), [r1])
+    assert_equal(db.get_run(r1)['options']['path'], prefix + '/a.npy')
+    db.add_stage_calls(r1, [(0, None, 'foo', 0, 1,
+                             encode_arguments({'a' : np.zeros(100)}),
+                             None, None, False)])
+    assert_equal(len(db.find_stage_calls(arguments={'a' : np.zeros(100)})),
+                 1)
+    assert_equal(db.find_stage_calls(arguments={'a' : np.ones(100)}), [])
+
+@with_setup(setup_directory, remove_directory)
+def test_ExperimentDB_inserts_and_finds_stage_calls():
+    db = ExperimentDB(os.path.join(directory, 'experiments.sqlite'))
+    run = db.add_run('ex', {})
+    db.add_stage_calls(run, [(i, None, 'foo', i, i + 0.5,
+                              encode_arguments({'i' : i % 10}),
+                              'fp', 'key{}'.format(i), i % 2 == 0)
+                             for i in range(1000)])
+    assert_equal(len(db.find_stage_calls(name='foo')), 1000)
+    calls = db.find_stage_calls(name='foo', arguments={'i' : 3},
+                                started_before=100)
+    assert_equal([c['seq'] for c in calls], [3, 13, 23, 33, 43, 53, 63, 73,
+                                             83, 93])
+    assert_equal(db.get_call_arguments(calls[0]['id']), {'i' : 3})
+    assert_equal(db.find_stage_calls(name='bar'), [])
+    assert_equal(len(db.find_stage_calls(fingerprint='fp', completed=True)),
+                 500)
+    assert_equal(db.completed_keys(['key3', 'key4', 'key1000']), {'key4'})
+
+
+@with_setup(setup_directory, remove_directory)
+def test_SQLiteReporter_records_experiment():
+    db = ExperimentDB(os.path.join(directory, 'experiments.sqlite'))
+    reporter = SQLiteReporter(db=db, batch_size=2)
+    ex1 = Experiment('ex', NO_LOGGER, NO_LOGGER, {'a' : 3}, CacheStub(),
+                     [reporter], seed=123)
+
+    @ex1.stage
+    def inner(x):
+        return 2 * x
+
+    @ex1.main
+    def outer(a, logger):
+        return inner(np.ones(a)).sum() + inner(a)
+
+    assert_equal(ex1(), 12)
+    run = db.get_run(db.find_runs(name='ex', options={'a' : 3})[0])
+    assert_equal(run['seed'], 123)
+    assert_equal(run['result'], 12)
+    calls = db.find_stage_calls(run=run['id'])
+    assert_equal([(c['name'], c['parent']) for c in calls],
+                 [('inner', 0), ('inner', 0), ('outer', None)])
+    assert_equal(db.get_call_arguments(calls[1]['id']), {'x' : 3})
+    assert_true('logger' not in db.get_call_arguments(calls[2]['id']))
+
+
+@with_setup(setup_directory, remove_directory)
+def test_completed_sections_are_found_and_loaded():
+    db = ExperimentDB(os.path.join(directory, 'experiments.sqlite'))
+    cache = TieredCache(DictCache())
+
+    def square(a):
+        return a * a
+
+    options = {'a' : 0, 's1' : {'a' : 1}, 's2' : {'a' : 2}, 's3' : {'a' : 3}}
+    reporter = SQLiteReporter(db=db)
+    ex1 = Experiment('ex', NO_LOGGER, NO_LOGGER, options, cache, [reporter],
+                     seed=123)
+    stage = ex1.stage(square)
+    stage.caching_threshold = -1
+    for o in ex1.optionsets(['s1', 's3']):
+        o.square()
+    reporter.flush()
+
+    ex2 = Experiment('ex', NO_LOGGER, NO_LOGGER, options, cache, [], seed=123)
+    ex2.stage(square)
+    completed = ex2.completed_sections(['s1', 's2', 's3'], db,
+                                       stage='square')
+    assert_equal(sorted(completed), ['s1', 's3'])
+    results = db.load_results(completed.values(), cache)
+    assert_equal(sorted(r for r, logs in results.values()), [1, 9])
+    calls = db.find_stage_calls(name='square', fingerprint=stage.fingerprint,
+                                options={'a' : 0}, completed=True)
+    assert_equal(len(calls), 2)
+
+
+@with_setup(setup_directory, remove_directory)
+def test_results_that_were_not_stored_are_not_completed():
+    db = ExperimentDB(os.path.join(directory, 'experiments.sqlite'))
+    # far too fast to be cached
+    cache = TieredCache(DictCache())
+    options = {'a' : 0, 's1' : {'a' : 1}}
+    reporter = SQLiteReporter(db=db)
+    ex1 = Experiment('ex', NO_LOGGER, NO_LOGGER, options, cache, [reporter],
+                     seed=123)
+
+    @ex1.stage
+    def square(a):
+        return a * a
+
+    ex1.optionset('s1').square()
+    reporter.flush()
+    assert_equal(ex1.completed_sections(['s1'], db, stage='square'), {})
+    calls = db.find_stage_calls(name='square')
+    assert_equal(len(calls), 1)
+    assert_true(calls[0]['key'] is not None)
+    assert_true(not calls[0]['stored'])
@@ -7,14 +7,25 @@
 from __future__ import division, print_function, unicode_literals
 
 import logging
-from tempfile import NamedTemporaryFile
+import numpy as np
+import os
+import shutil
+import subprocess
+import sys
+from tempfile import NamedTemporaryFile, mkdtemp
+import threading
+import time
 
 from helpers import *
 from ..factory import createExperiment, create_basic_Experiment
+from ..caches import BoundedCache, SQLiteCache, TieredCache
+from ..stage import RANDOM_SEED_RANGE
 
 # don't gather logging spam
 logging.disable(logging.CRITICAL)
 
+IMPORT_TIME_LIMIT = 1.0 # seconds
+
 def test_Experiment_constructor_works():
     ex1 = create_basic_Experiment()
 
@@ -235,3 +246,377 @@ def test_repeated_fill_args_are_seeded_differently():
 
     assert_not_equal(r1, r2)
 
+def test_stage_get_key_is_stable_digest():
+    ex1 = create_basic_Experiment()
+    @ex1.stage
+    def foo(a, b=2): pass
+
+    k1 = foo.get_key({'a' : 1, 'b' : [1, 2]})
+    k2 = foo.get_key({'b' : [1, 2], 'a' : 1})
+    assert_equal(k1, k2)
+    assert_true(isinstance(k1, basestring))
+    assert_not_equal(k1, foo.get_key({'a' : 2, 'b' : [1, 2]}))
+
+def test_stage_results_are_retrieved_from_cache():
+    ex1 = create_basic_Experiment()
+    ex1.cache = BoundedCache(DictCache(), max_bytes=10000, min_exec_time=0)
+    calls = []
+    @ex1.stage
+    def foo(a):
+        calls.append(a)
+        return a * 2
+
+    assert_equal(foo(3), 6)
+    assert_equal(foo(3), 6)
+    assert_equal(calls, [3])
+
+def test_stage_waits_for_concurrent_computation_of_same_result():
+    directory = mkdtemp()
+    try:
+        ex1 = create_basic_Experiment()
+        ex1.cache = SQLiteCache(directory, poll_interval=0.01)
+        calls = []
+        @ex1.stage
+        def foo(a):
+            calls.append(a)
+            time.sleep(0.1)
+            return a * 2
+        foo.caching_threshold = 0
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(foo(3)))
+                   for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert_equal(results, [6, 6, 6])
+        assert_equal(calls, [3])
+    finally:
+        shutil.rmtree(directory)
+
+def test_stage_fingerprint_ignores_comments_and_docstrings():
+    ex = create_basic_Experiment()
+    @ex.stage
+    def foo(a, b=2):
+        return a + b
+    f1 = foo.fingerprint
+
+    ex = create_basic_Experiment()
+    @ex.stage
+    def foo(a,
+            b = 2):
+        """
+        Adds b to a.
+        """
+        # this is a comment
+        return (a +
+                b) # another comment
+    f2 = foo.fingerprint
+
+    ex = create_basic_Experiment()
+    @ex.stage
+    def foo(a, b=2):
+        return a - b
+    f3 = foo.fingerprint
+
+    assert_equal(f1, f2)
+    assert_not_equal(f1, f3)
+
+def create_nested_stages(ex, increment):
+    if increment == 1:
+        @ex.stage
+        def callee(a):
+            return a + 1
+    else:
+        @ex.stage
+        def callee(a):
+            return a + 2
+
+    @ex.stage
+    def caller(a):
+        return callee(a) * 2
+    return caller
+
+def test_stage_cache_key_depends_on_called_stages():
+    cache = BoundedCache(DictCache(), max_bytes=10000, min_exec_time=0)
+    ex1 = create_basic_Experiment()
+    ex1.cache = cache
+    caller1 = create_nested_stages(ex1, 1)
+    ex2 = create_basic_Experiment()
+    ex2.cache = cache
+    caller2 = create_nested_stages(ex2, 2)
+
+    assert_equal(caller1.fingerprint, caller2.fingerprint)
+    assert_not_equal(caller1.get_key({'a' : 1}), caller2.get_key({'a' : 1}))
+    assert_equal(caller1(1), 4)
+    assert_equal(caller2(1), 6)
+
+def test_stage_learns_dynamically_called_stages():
+    ex1 = create_basic_Experiment()
+    ex1.cache = BoundedCache(DictCache(), max_bytes=10000, min_exec_time=0)
+    stages = {}
+    @ex1.stage
+    def callee(a):
+        return a + 1
+    stages['callee'] = callee
+
+    @ex1.stage
+    def caller(a):
+        return stages['callee'](a)
+
+    key_before = caller.get_key({'a' : 1})
+    assert_equal(caller(1), 2)
+    assert_equal(caller.called_stages, {callee.qualified_name})
+    key_after = caller.get_key({'a' : 1})
+    assert_not_equal(key_before, key_after)
+    assert_true(key_after in ex1.cache.cache)
+
+def test_rejected_called_stages_do_not_fail_the_stage():
+    ex1 = create_basic_Experiment()
+    ex1.cache = BoundedCache(DictCache(), max_bytes=885, policy='cost',
+                             min_exec_time=0)
+    # an expensive entry that leaves no room for anything else
+    assert_true(ex1.cache.offer('expensive', np.zeros(110), 1000))
+    stages = {}
+    @ex1.stage
+    def callee(a):
+        return a + 1
+    stages['callee'] = callee
+
+    @ex1.stage
+    def caller(a):
+        return stages['callee'](a)
+
+    assert_equal(caller(1), 2)
+    assert_equal(caller.called_stages, {callee.qualified_name})
+
+def test_stage_results_handler_is_attached_once():
+    ex1 = create_basic_Experiment()
+
+    @ex1.stage
+    def quiet(a):
+        return a
+
+    @ex1.stage
+    def loud(a, logger):
+        logger.append_result(a=a)
+        return a
+
+    assert_equal(quiet.results_logger.handlers, [])
+    assert_equal(loud.results_logger.handlers, [loud.results_handler])
+    loud(1)
+    loud(2)
+    assert_equal(loud.results_logger.handlers, [loud.results_handler])
+    assert_equal(len(loud.results_handler.results), 0)
+
+class EventCounter(object):
+    def __init__(self):
+        self.started = []
+
+    def stage_started_event(self, name, start_time, arguments):
+        self.started.append((name, arguments))
+
+def test_sweep_runs_option_sections_in_parallel():
+    ex1 = create_basic_Experiment()
+    ex1.options.update({'a' : 1, 'first' : {'a' : 2}, 'second' : {'a' : 3}})
+    counter = EventCounter()
+    ex1.add_observer(counter)
+
+    @ex1.stage
+    def foo(a, rnd, logger):
+        logger.append_result(a=a)
+        return a * 10 + rnd.randint(10)
+
+    results = ex1.sweep(['first', 'second', 'first'], stage='foo', processes=2)
+    assert_equal([r // 10 for r, logs in results], [2, 3, 2])
+    assert_equal(results[0], results[2])
+    assert_equal([logs['a'] for r, logs in results], [[2], [3], [2]])
+    assert_equal([(n, args['a']) for n, args in counter.started],
+                 [('foo', 2), ('foo', 3), ('foo', 2)])
+    assert_equal(ex1.sweep(['second'], stage='foo', processes=1)[0],
+                 results[1])
+
+def test_optionsets_prefetch_cached_results():
+    backend = CountingCache()
+
+    def double(a):
+        return 2 * a
+
+    for prefetch in [False, True]:
+        ex1 = create_basic_Experiment()
+        ex1.options.update({'first' : {'a' : 2}, 'second' : {'a' : 3}})
+        ex1.cache = TieredCache(backend)
+        stage = ex1.stage(double)
+        stage.caching_threshold = -1
+        sets = ex1.optionsets(['first', 'second'], prefetch=prefetch)
+        first = next(sets)
+        if prefetch:
+            while ex1.cache.pending:
+                time.sleep(0.01)
+            assert_equal(len(ex1.cache.memory), 2)
+        reads = backend.reads
+        results = [first.double()] + [o.double() for o in sets]
+        assert_equal(results, [4, 6])
+    # served from memory
+    assert_equal(backend.reads, reads)
+    assert_equal(stage.statistics.cache_hits, 2)
+
+def test_stage_resumes_from_checkpoint():
+    crash_at = [3]
+    steps_run = []
+
+    def train(steps, rnd, checkpoint):
+        state = checkpoint.load(default=(0, 0.))
+        for step in range(state[0], steps):
+            if step == crash_at[0]:
+                raise RuntimeError("crash")
+            steps_run.append(step)
+            state = step + 1, state[1] + rnd.rand()
+            checkpoint.save(state)
+        return state[1]
+
+    backend = DictCache()
+    ex1 = create_basic_Experiment()
+    ex1.cache = TieredCache(backend)
+    try:
+        ex1.stage(train)(5)
+        assert False, "RuntimeError expected"
+    except RuntimeError:
+        pass
+    # restart
+    crash_at[0] = None
+    ex2 = create_basic_Experiment()
+    ex2.cache = TieredCache(backend)
+    result = ex2.stage(train)(5)
+    assert_equal(steps_run, [0, 1, 2, 3, 4])
+    # the checkpoint is gone
+    assert_true(not any(isinstance(k, tuple) and k[0] == 'checkpoint'
+                        for k in backend))
+
+    ex3 = create_basic_Experiment()
+    ex3.cache = TieredCache(DictCache())
+    assert_equal(ex3.stage(train)(5), result)
+
+def test_rejected_checkpoints_do_not_fail_the_stage():
+    ex1 = create_basic_Experiment()
+    # too small for the rnd state that is saved with every checkpoint
+    ex1.cache = BoundedCache(DictCache(), max_bytes=100, policy='cost',
+                             min_exec_time=0)
+    saved = []
+
+    @ex1.stage
+    def train(steps, checkpoint):
+        for step in range(steps):
+            saved.append(checkpoint.save(step))
+        return steps
+
+    assert_equal(train(3), 3)
+    assert_equal(saved, [False] * 3)
+
+def test_stage_repeat_computes_mean_and_var():
+    ex1 = create_basic_Experiment()
+    @ex1.stage
+    def foo(a, rnd):
+        return a + rnd.randn(3)
+
+    stats = foo.repeat(20, args=(5,))
+    assert_equal(stats.n, 20)
+    assert_equal(stats.mean.shape, (3,))
+    assert_true(np.all(np.abs(stats.mean - 5) < 1.5))
+
+    seeds = np.random.RandomState(foo.seed).randint(*RANDOM_SEED_RANGE,
+                                                    size=20)
+    results = [5 + np.random.RandomState(s).randn(3) for s in seeds]
+    assert_allclose(stats.mean, np.mean(results, axis=0))
+    assert_allclose(stats.var, np.var(results, axis=0))
+
+def test_stage_repeat_in_pools_is_deterministic():
+    ex1 = create_basic_Experiment()
+    @ex1.stage
+    def foo(rnd):
+        return rnd.randn()
+
+    serial = foo.repeat(10)
+    threaded = foo.repeat(10, workers=3)
+    processes = foo.repeat(10, workers=3, pool='process')
+    assert_equal(threaded.mean, serial.mean)
+    assert_equal(threaded.var, serial.var)
+    assert_equal(processes.mean, serial.mean)
+    assert_equal(processes.var, serial.var)
+
+def test_stage_does_not_build_key_without_cache():
+    ex1 = create_basic_Experiment()
+    ex1.cache = None
+    @ex1.stage
+    def foo(a):
+        return a
+
+    def fail(arguments):
+        raise AssertionError("key was built")
+    foo.get_key = fail
+    assert_equal(foo(2), 2)
+
+def test_stage_result_logs_are_separate_for_each_call():
+    ex1 = create_basic_Experiment()
+    ex1.cache = BoundedCache(DictCache(), max_bytes=10000, min_exec_time=0)
+    @ex1.stage
+    def foo(n, logger):
+        for i in range(n):
+            logger.append_result(i=i)
+        if n > 1:
+            foo(n - 1)
+        return n
+
+    foo(3)
+    r1, logs1 = ex1.cache.cache[foo.get_key({'n' : 1})]
+    r3, logs3 = ex1.cache.cache[foo.get_key({'n' : 3})]
+    assert_equal(logs1['i'], [0])
+    assert_equal(logs3['i'], [0, 1, 2, 0, 1, 0])
+
+def test_experiment_collects_stage_statistics():
+    ex1 = create_basic_Experiment()
+    ex1.cache = BoundedCache(DictCache(), max_bytes=100000, min_exec_time=0)
+    @ex1.stage
+    def foo(a):
+        return np.zeros(100) + a
+
+    @ex1.stage
+    def bar(b):
+        pass
+
+    foo(1)
+    foo(1)
+    foo(2)
+    bar(1)
+    ex1.statistics.profile('bar')
+    bar(2)
+    stats = ex1.statistics['foo']
+    assert_equal(stats.calls, 3)
+    assert_equal(stats.cache_hits, 1)
+    assert_equal(stats.cache_misses, 2)
+    assert_true(stats.bytes_read >= 800)
+    assert_equal(stats.bytes_written, 2 * stats.bytes_read)
+    assert_true(stats.min_time <= stats.percentile(50) <= stats.max_time)
+    assert_equal(ex1.statistics['bar'].calls, 2)
+    assert_true(ex1.statistics['bar'].profile_stats is not None)
+    assert_equal(ex1.statistics.hottest(1, by='calls')[0].name, 'foo')
+    assert_equal(len(ex1.statistics.summary()), 2)
+
+
+
+def test_import_is_fast_and_does_not_load_optional_modules():
+    code = ("import sys, time\n"
+            "start = time.time()\n"
+            "import mlizard\n"
+            "print(time.time() - start)\n"
+            "print(' '.join(sys.modules))")
+    package_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=package_dir)
+    import_time, modules = output.decode().strip().split('\n')
+    modules = set(m.split('.')[0] for m in modules.split())
+    for name in ['matplotlib', 'jinja2', 'couchdb', 'configobj']:
+        assert_true(name not in modules, name)
+    assert_less(float(import_time), IMPORT_TIME_LIMIT)
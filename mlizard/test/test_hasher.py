@@ -10,7 +10,7 @@ from __future__ import division, print_function, unicode_literals
 import numpy as np
 
 from helpers import assert_not_equal, assert_true, assert_equal
-from ..caches import sshash
+from ..caches import sshash, digest, Hasher
 
 def test_sshash_distinct_int_hashes():
     assert_not_equal(sshash(1), sshash(2))
@@ -97,4 +97,57 @@ class bar(object):
 
 def test_sshash_uses_hash_method():
     f = bar()
-    assert_equal(sshash(f), 27)
\ No newline at end of file
+    assert_equal(sshash(f), 27)
+
+def test_digest_is_deterministic():
+    # must not change between python processes (e.g. PYTHONHASHSEED)
+    assert_equal(digest(17),
+        '6f897b75d5f96dd8e6af3e5d40684fa5de5b2a666d76d86699c76448ceabddca')
+
+def test_digest_equal_dicts_equal_results():
+    a = {'a':1, 'b':[2, 3], 'c':(4, None)}
+    b = {'c':(4, None), 'b':[2, 3], 'a':1}
+    assert_equal(digest(a), digest(b))
+
+def test_digest_ascii_bytes_and_unicode_match():
+    assert_equal(digest({b'a' : b'foo'}), digest({u'a' : u'foo'}))
+
+def test_digest_distinguishes_types():
+    assert_not_equal(digest(1), digest('1'))
+    assert_not_equal(digest((1, 2)), digest([1, 2]))
+    assert_not_equal(digest(['ab', 'c']), digest(['a', 'bc']))
+
+def test_digest_nparrays():
+    a = np.arange(12).reshape(3,4)
+    assert_equal(digest(a), digest(np.arange(12).reshape(3,4)))
+    assert_not_equal(digest(a), digest(np.arange(12).reshape(4,3)))
+    assert_not_equal(digest(a), digest(a.astype(np.float64)))
+
+def test_digest_nparrays_independent_of_memory_layout_flags():
+    a = np.arange(12.).reshape(3,4)
+    assert_equal(digest(a[:, ::2]), digest(a[:, ::2].copy()))
+    f = np.asfortranarray(a)
+    assert_true(f.flags.f_contiguous and not f.flags.c_contiguous)
+    assert_equal(digest(f), digest(a))
+    assert_equal(digest(f.T), digest(a.T.copy()))
+
+def test_Hasher_memoizes_readonly_arrays():
+    h = Hasher()
+    a = np.arange(10)
+    a.flags.writeable = False
+    d = h.digest(a)
+    assert_true(id(a) in h.memo)
+    assert_equal(h.digest(a), d)
+    del a
+    assert_equal(len(h.memo), 0)
+
+def test_Hasher_does_not_memoize_writeable_arrays():
+    h = Hasher()
+    a = np.arange(10)
+    d = h.digest(a)
+    assert_equal(len(h.memo), 0)
+    a[0] = 7
+    assert_not_equal(h.digest(a), d)
+
+def test_sshash_nparray_returns_int():
+    assert_equal(type(sshash(np.arange(5))), int)
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# coding=utf-8
+# This file is part of the MLizard library published under the GPL3 license.
+# Copyright (C) 2012  Klaus Greff
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, print_function, unicode_literals
+
+import logging
+import multiprocessing
+import numpy as np
+import os
+import pickle
+import shutil
+import time
+from tempfile import mkdtemp
+
+from helpers import *
+from ..log import ResultLogHandler, ResultSeries, StageFunctionLoggerFacade
+
+
+def create_facade(handler):
+    results_logger = logging.getLogger("test_log_results")
+    results_logger.handlers = [handler]
+    results_logger.propagate = False
+    results_logger.setLevel(logging.DEBUG)
+    return StageFunctionLoggerFacade(logging.getLogger("test_log"),
+                                     results_logger)
+
+
+def test_result_series_all_keeps_every_value():
+    s = ResultSeries(0)
+    for i in range(1, 1000):
+        s.append(i)
+    assert_equal(len(s), 1000)
+    assert_equal(s[10], 10)
+    assert_equal(s, list(range(1000)))
+    assert_equal(np.asarray(s).sum(), sum(range(1000)))
+
+
+def test_result_series_promotes_dtype():
+    s = ResultSeries(1)
+    s.append(2.5)
+    assert_equal(s.tolist(), [1.0, 2.5])
+
+
+def test_result_series_spills_to_file():
+    spill_dir = mkdtemp()
+    s = ResultSeries(0.0, max_memory=1024, spill_dir=spill_dir)
+    for i in range(1, 1000):
+        s.append(float(i))
+    assert isinstance(s.values, np.memmap)
+    assert_equal(len(os.listdir(spill_dir)), 1)
+    s2 = pickle.loads(pickle.dumps(s))
+    assert_equal(s2, list(range(1000)))
+    del s
+    assert_equal(os.listdir(spill_dir), [])
+    shutil.rmtree(spill_dir)
+
+
+def test_result_series_downsample():
+    s = ResultSeries(0, mode='downsample', capacity=10)
+    for i in range(1, 100):
+        s.append(i)
+    assert len(s) <= 10
+    assert_equal(np.asarray(s), s.steps())
+
+
+def test_result_series_reservoir():
+    s = ResultSeries(0, mode='reservoir', capacity=10)
+    for i in range(1, 100):
+        s.append(i)
+    assert_equal(len(s), 10)
+    assert_equal(len(set(s.tolist())), 10)
+    assert all(0 <= v < 100 for v in s)
+
+
+def test_result_log_handler_stores_numbers_in_series():
+    handler = ResultLogHandler(series_mode='reservoir', series_capacity=5)
+    logger = create_facade(handler)
+    for i in range(20):
+        logger.append_result(loss=0.5 * i, name='step')
+    assert isinstance(handler.results['loss'], ResultSeries)
+    assert_equal(len(handler.results['loss']), 5)
+    assert_equal(handler.results['name'], ['step'] * 20)
+
+
+def test_result_log_handler_falls_back_to_list():
+    handler = ResultLogHandler()
+    logger = create_facade(handler)
+    logger.append_result(a=1)
+    logger.append_result(a=2)
+    logger.append_result(a='three')
+    assert_equal(handler.results['a'], [1, 2, 'three'])
+
+
+def test_live_plots_do_not_block_logging():
+    # the plots are rendered in another process
+    frames = multiprocessing.Queue()
+
+    def slow_plot():
+        results = yield None
+        while True:
+            time.sleep(0.1)
+            frames.put(results)
+            results = yield None
+
+    handler = ResultLogHandler()
+    handler.plotting_delay = 0
+    handler.add_plot(slow_plot)
+    logger = create_facade(handler)
+    start = time.time()
+    for i in range(200):
+        logger.append_result(loss=i)
+    assert time.time() - start < 0.1
+    handler.stop_plots()
+    received = []
+    while not frames.empty():
+        received.append(frames.get())
+    assert 1 <= len(received) <= 5
+    assert_equal(received[-1]['loss'], list(range(200)))
+
+
+def test_failing_live_plots_are_logged_and_dropped():
+    def broken_plot():
+        results = yield None
+        raise ValueError("broken")
+
+    handler = ResultLogHandler()
+    handler.plotting_delay = 0
+    handler.add_plot(broken_plot)
+    logger = create_facade(handler)
+    for i in range(10):
+        logger.append_result(loss=i)
+    renderer = handler.renderer
+    handler.stop_plots()
+    assert_true(not renderer.process.is_alive())
+    assert_equal(renderer.process.exitcode, 0)
+    assert_equal(renderer.frames, 0)
+    assert_equal(handler.snapshot()['loss'], list(range(10)))
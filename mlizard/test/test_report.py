@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# coding=utf-8
+# This file is part of the MLizard library published under the GPL3 license.
+# Copyright (C) 2012  Klaus Greff
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import division, print_function, unicode_literals
+
+import json
+import numpy as np
+import os
+import shutil
+from tempfile import mkdtemp
+import time
+import uuid
+import weakref
+
+from helpers import *
+from ..report import AsyncDispatcher, CallTable, CompleteReporter
+from ..report import IncrementalCouchDBReporter, JinjaReporter
+from ..report import summarize
+
+
+class SlowObserver(object):
+    def __init__(self):
+        self.events = []
+
+    def stage_started_event(self, name, start_time, arguments):
+        time.sleep(0.01)
+        self.events.append(name)
+
+    def experiment_completed_event(self, stop_time, result):
+        self.events.append(result)
+
+
+class BatchObserver(object):
+    def __init__(self):
+        self.batches = []
+
+    def process_events(self, events):
+        self.batches.append(events)
+
+
+def test_AsyncDispatcher_does_not_block_on_slow_observers():
+    slow = SlowObserver()
+    dispatcher = AsyncDispatcher([slow])
+    start = time.time()
+    for i in range(20):
+        dispatcher.stage_started_event('foo%d' % i, 0, {})
+    assert_true(time.time() - start < 0.1)
+    dispatcher.experiment_completed_event(0, 'done')
+    assert_equal(slow.events, ['foo%d' % i for i in range(20)] + ['done'])
+
+def test_AsyncDispatcher_delivers_batches():
+    batch_observer = BatchObserver()
+    dispatcher = AsyncDispatcher([batch_observer], batch_size=5)
+    for i in range(10):
+        dispatcher.stage_completed_event(i)
+    dispatcher.flush()
+    events = sum(batch_observer.batches, [])
+    assert_equal(events, [('stage_completed_event', (i,)) for i in range(10)])
+    assert_true(all(len(b) <= 5 for b in batch_observer.batches))
+
+def test_AsyncDispatcher_keeps_CompleteReporter_consistent():
+    reporter = CompleteReporter()
+    dispatcher = AsyncDispatcher([reporter], max_queue_size=2)
+    dispatcher.experiment_created_event('test', {})
+    dispatcher.experiment_started_event(0, 123, (), {})
+    dispatcher.stage_started_event('foo', 1, {'a' : 1})
+    dispatcher.stage_started_event('bar', 2, {})
+    dispatcher.stage_completed_event(3)
+    dispatcher.stage_completed_event(4)
+    dispatcher.experiment_completed_event(5, 'result')
+    entry = reporter.experiment_entry
+    assert_equal(entry['result'], 'result')
+    assert_equal(entry['called'][0]['name'], 'foo')
+    assert_equal(entry['called'][0]['execution_time'], 3)
+    assert_equal(entry['called'][0]['called'][0]['name'], 'bar')
+
+
+def test_CompleteReporter_does_not_keep_arguments_alive():
+    reporter = CompleteReporter()
+    reporter.experiment_created_event('test', {})
+    reporter.experiment_started_event(0, 123, (), {})
+    a = np.zeros(1000)
+    a_ref = weakref.ref(a)
+    reporter.stage_started_event('foo', 1, {'a' : a, 'b' : 2})
+    reporter.stage_completed_event(3)
+    del a
+    assert_true(a_ref() is None)
+    reporter.experiment_completed_event(5, None)
+    call = reporter.experiment_entry['called'][0]
+    assert_equal(call['arguments']['b'], 2)
+    assert_true('shape=(1000,)' in call['arguments']['a'])
+
+def test_CallTable_builds_call_tree():
+    table = CallTable()
+    for i in range(3):
+        foo = table.add_call('foo', -1, 10 * i, {'a' : 1})
+        bar = table.add_call('bar', foo, 10 * i + 1, {})
+        table.complete_call(bar, 10 * i + 2)
+        table.complete_call(foo, 10 * i + 3)
+    running = table.add_call('foo', -1, 40, {'a' : 1})
+    assert_equal(len(table), 7)
+    assert_equal(len(table.summaries), 2)
+    tree = table.build_tree()
+    assert_equal([c['name'] for c in tree], ['foo'] * 4)
+    assert_equal([c['execution_time'] for c in tree], [3, 3, 3, None])
+    assert_equal([[b['name'] for b in c['called']] for c in tree],
+                 [['bar']] * 3 + [[]])
+    assert_equal(tree[0]['arguments'], {'a' : 1})
+
+
+def test_JinjaReporter_writes_checkpoints_and_caps_call_details():
+    directory = mkdtemp()
+    try:
+        path = os.path.join(directory, 'test.report')
+        reporter = JinjaReporter(checkpoint_interval=0, max_call_details=2)
+        reporter.experiment_created_event('test', {'a' : 1})
+        reporter.experiment_entry['report_filename'] = path
+        reporter.experiment_mainfile_found_event('test.py', None)
+        reporter.experiment_started_event(0, 123, (), {})
+        reporter.stage_created_event('foo', None, 'source', None)
+        for i in range(5):
+            reporter.stage_started_event('foo', i, {'i' : i})
+            reporter.stage_completed_event(i + 0.5)
+            if i == 0:
+                with open(path) as f:
+                    report = f.read()
+                assert_true('(not finished)' in report)
+                assert_equal(report.count(':args:'), 1)
+        reporter.experiment_completed_event(10, 'the result')
+        with open(path) as f:
+            report = f.read()
+        assert_true('the result' in report)
+        assert_equal(report.count(':args:'), 2)
+        assert_true('3 more calls' in report)
+        assert_equal(len(reporter.experiment_entry['called']), 2)
+        assert_equal(os.listdir(directory), ['test.report'])
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_JinjaReporter_without_cap_describes_all_calls():
+    directory = mkdtemp()
+    try:
+        path = os.path.join(directory, 'test.report')
+        reporter = JinjaReporter(max_call_details=None)
+        reporter.experiment_created_event('test', {})
+        reporter.experiment_entry['report_filename'] = path
+        reporter.experiment_started_event(0, 123, (), {})
+        reporter.stage_created_event('foo', None, 'source', None)
+        for i in range(3):
+            reporter.stage_started_event('foo', i, {'i' : i})
+            reporter.stage_completed_event(i + 0.5)
+        reporter.experiment_completed_event(10, 'the result')
+        with open(path) as f:
+            report = f.read()
+        assert_equal(report.count(':args:'), 3)
+        assert_true('more calls' not in report)
+    finally:
+        shutil.rmtree(directory)
+
+class FakeCouchDB(object):
+    """Stand-in for a couchdb.Database that stores the documents as JSON."""
+    def __init__(self):
+        self.docs = {}
+        self.saves = 0
+        self.bulk_updates = 0
+
+    def save(self, doc):
+        self.saves += 1
+        doc.setdefault('_id', uuid.uuid4().hex)
+        doc['_rev'] = str(int(doc.get('_rev', 0)) + 1)
+        self.docs[doc['_id']] = json.loads(json.dumps(doc))
+        return doc['_id'], doc['_rev']
+
+    def update(self, docs):
+        self.bulk_updates += 1
+        for doc in docs:
+            self.docs[doc['_id']] = json.loads(json.dumps(doc))
+        return [(True, doc['_id'], '1') for doc in docs]
+
+def test_IncrementalCouchDBReporter_writes_stage_calls_in_bulk():
+    db = FakeCouchDB()
+    reporter = IncrementalCouchDBReporter(db=db, batch_size=10)
+    reporter.experiment_created_event('test', {'a' : 1})
+    reporter.stage_created_event('foo', 'doc', 'source', {})
+    reporter.experiment_started_event(0, 123, (), {})
+    for i in range(25):
+        reporter.stage_started_event('foo', i, {'a' : np.zeros(1000),
+                                                'logger' : object()})
+        reporter.stage_started_event('bar', i, {'b' : 'x' * 1000})
+        reporter.stage_completed_event(i + 0.5)
+        reporter.stage_completed_event(i + 1)
+    reporter.experiment_completed_event(30, 'result')
+
+    assert_equal(db.saves, 3)
+    assert_equal(db.bulk_updates, 5)
+    experiment = db.docs[reporter.experiment_entry['_id']]
+    assert_equal(experiment['result'], 'result')
+    assert_equal(experiment['stage_calls'], 50)
+    assert_true('foo' in experiment['stages'])
+    calls = [d for d in db.docs.values() if d.get('type') == 'stage_call']
+    assert_equal(len(calls), 50)
+    foo_calls = [c for c in calls if c['name'] == 'foo']
+    bar_calls = [c for c in calls if c['name'] == 'bar']
+    assert_true(all(c['parent'] is None for c in foo_calls))
+    foo_ids = set(c['_id'] for c in foo_calls)
+    assert_true(all(c['parent'] in foo_ids for c in bar_calls))
+    assert_equal(foo_calls[0]['arguments'],
+                 {'a' : '<ndarray shape=(1000,) dtype=float64>'})
+    assert_true(len(bar_calls[0]['arguments']['b']) <= 80)
+
+
+def test_summarize_does_not_build_the_full_repr():
+    class Huge(list):
+        def __repr__(self):
+            raise AssertionError("full repr")
+
+    assert_equal(summarize(Huge(range(10))), '<Huge len=10>')
+    summary = summarize(list(range(10**6)))
+    assert_true(summary.startswith('[0, 1, 2') and len(summary) <= 80)
+    assert_equal(summarize([np.zeros((2, 3))]),
+                 '[<ndarray shape=(2, 3) dtype=float64>]')
+    assert_equal(summarize('x' * 100), 'x' * 77 + '...')